@@ -0,0 +1,232 @@
+"""
+Benchmarks the per-minute and top-of-hour work of the license plugin against synthetic tenants of growing size.
+
+For every scale, a MockTenant with that many hosts and entities is started in its own process, and every
+benchmarked function runs in a fresh process, so the peak RSS measured is the plugin's alone. Wall time,
+peak RSS, API calls and bytes sent and received are stored as a JSON baseline, which the compare command
+checks a later run against.
+
+Usage:
+python bench/benchmark.py run --scales 1000,10000 --output bench/baselines/current.json
+python bench/benchmark.py compare bench/baselines/baseline.json bench/baselines/current.json
+"""
+import argparse
+import datetime
+import json
+import math
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+FUNCTIONS = (
+    "get_consumption_for_host_units",
+    "push_consumption_for_host_units",
+    "calculate_and_push_consumption_for_dem",
+    "calculate_and_push_consumption_for_ddu",
+    "add_management_zone_rule"
+)
+SCALES = (1000, 10000, 100000, 500000)
+MEASUREMENTS = ("wall_time", "peak_rss", "requests", "bytes")
+# Relative increase over the baseline reported as a regression, API calls are deterministic so any increase counts
+REGRESSION_THRESHOLDS = {"wall_time": 0.25, "peak_rss": 0.2, "requests": 0.0, "bytes": 0.05}
+TENANT_STARTUP_TIMEOUT = 30
+
+BENCH_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+def reset_peak_rss():
+    """
+    Resets the peak RSS of this process on Linux, so it only covers what runs afterwards.
+    """
+    try:
+        with open("/proc/self/clear_refs", mode="w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+def peak_rss():
+    """
+    :return: Peak resident set size of this process in bytes
+    """
+    try:
+        with open("/proc/self/status", mode="r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+    # Kilobytes on Linux, bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+def start_execution(plugin):
+    """
+    Sets up what query() sets up before any work, without limiting the execution's API calls or time.
+    """
+    plugin.current_millis = int(time.time() * 1000)
+    plugin.last_millis = plugin.current_millis - 60 * 60 * 1000
+    plugin.request_budget = math.inf
+    plugin.request_deadline = math.inf
+    plugin.request_stats = {key: 0 for key in plugin.request_stats}
+    plugin.phase_stats = []
+    plugin.fetched_entity_types = set()
+    plugin.missing_entities = set()
+    plugin.entity_cache_synced = {}
+    if plugin.host_metadata is None:
+        plugin.load_hosts({})
+
+def run_case(function, tenant_url):
+    """
+    Runs one benchmarked function against the tenant at ``tenant_url`` and measures it.
+
+    :return: dict with the wall time in seconds, the peak RSS in bytes, the API calls and the bytes sent and received
+    """
+    from harness import PluginHarness
+    with PluginHarness(tenant_url) as harness:
+        plugin = harness.plugin
+        start_execution(plugin)
+        if function == "get_consumption_for_host_units":
+            call = lambda: plugin.get_consumption_for_host_units({})
+        elif function == "push_consumption_for_host_units":
+            hosts = {}
+            plugin.get_consumption_for_host_units(hosts)
+            for host in hosts.values():
+                host["seen"] = 60
+            call = lambda: plugin.push_consumption_for_host_units(hosts)
+        elif function == "calculate_and_push_consumption_for_dem":
+            call = lambda: plugin.calculate_and_push_consumption_for_dem({}, plugin.last_millis, plugin.current_millis)
+        elif function == "calculate_and_push_consumption_for_ddu":
+            plugin.get_consumption_for_host_units({})
+            call = lambda: plugin.calculate_and_push_consumption_for_ddu({}, plugin.host_metadata, plugin.last_millis, plugin.current_millis)
+        elif function == "add_management_zone_rule":
+            call = plugin.add_management_zone_rule
+        else:
+            raise ValueError(f"Unknown function {function}")
+        stats_before = dict(plugin.request_stats)
+        reset_peak_rss()
+        started = time.perf_counter()
+        call()
+        wall_time = time.perf_counter() - started
+        return {
+            "wall_time": wall_time,
+            "peak_rss": peak_rss(),
+            "requests": plugin.request_stats["requests"] - stats_before["requests"],
+            "bytes": plugin.request_stats["bytes"] - stats_before["bytes"]
+        }
+
+def start_tenant(scale, args):
+    """
+    Starts a MockTenant with ``scale`` hosts and entities in its own process.
+
+    :return: The process and the URL of the tenant
+    """
+    command = [
+        sys.executable, os.path.join(BENCH_DIRECTORY, "mock_tenant.py"), "--port", "0",
+        "--hosts", str(scale), "--entities", str(scale), "--applications", str(max(scale // 100, 10)),
+        "--aws-entities", str(max(scale // 1000, 10)), "--tags", str(args.tags), "--management-zones", str(args.management_zones),
+        "--latency", str(args.latency)
+    ]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, universal_newlines=True)
+    deadline = time.time() + TENANT_STARTUP_TIMEOUT
+    while time.time() < deadline:
+        line = process.stdout.readline()
+        if line.startswith("Serving a synthetic tenant on "):
+            return process, line.split(" on ")[1].split(",")[0]
+        if not line and process.poll() is not None:
+            break
+    process.kill()
+    raise RuntimeError("The mock tenant did not start")
+
+def run(args):
+    functions = args.functions.split(",") if args.functions else FUNCTIONS
+    scales = [int(scale) for scale in args.scales.split(",")] if args.scales else SCALES
+    results = {function: {} for function in functions}
+    for scale in scales:
+        process, tenant_url = start_tenant(scale, args)
+        try:
+            for function in functions:
+                measurements = []
+                for _ in range(args.repeat):
+                    output = subprocess.run([sys.executable, os.path.abspath(__file__), "case", function, tenant_url], stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout
+                    measurements.append(json.loads(output.strip().splitlines()[-1]))
+                result = {key: statistics.median(measurement[key] for measurement in measurements) for key in MEASUREMENTS}
+                results[function][str(scale)] = result
+                print(f"{function:<42} {scale:>7} {result['wall_time']:>9.3f}s {result['peak_rss'] / 1024 / 1024:>8.1f} MB {result['requests']:>7} calls {result['bytes'] / 1024 / 1024:>9.2f} MB transferred", flush=True)
+        finally:
+            process.kill()
+            process.wait()
+    baseline = {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeat": args.repeat,
+        "results": results
+    }
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, mode="w", encoding="utf-8") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Wrote {args.output}")
+
+def compare(args):
+    """
+    Compares the results of ``args.current`` with ``args.baseline``.
+
+    :return: 1 if a measurement regressed beyond its threshold, 0 otherwise
+    """
+    with open(args.baseline, mode="r", encoding="utf-8") as f:
+        baseline = json.load(f)["results"]
+    with open(args.current, mode="r", encoding="utf-8") as f:
+        current = json.load(f)["results"]
+    thresholds = dict(REGRESSION_THRESHOLDS)
+    if args.time_threshold is not None:
+        thresholds["wall_time"] = args.time_threshold
+    regressions = 0
+    for function in sorted(current):
+        for scale in sorted(current[function], key=int):
+            if scale not in baseline.get(function, {}):
+                print(f"{function:<42} {scale:>7} no baseline")
+                continue
+            for key in MEASUREMENTS:
+                before = baseline[function][scale][key]
+                after = current[function][scale][key]
+                change = (after - before) / before if before else (math.inf if after else 0.0)
+                regressed = change > thresholds[key]
+                regressions += regressed
+                print(f"{function:<42} {scale:>7} {key:<10} {before:>14.3f} -> {after:>14.3f} {change:>+8.1%}" + ("  REGRESSION" if regressed else ""))
+    print(f"{regressions} regressions")
+    return 1 if regressions else 0
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the license plugin against synthetic tenants.")
+    commands = parser.add_subparsers(dest="command")
+    run_parser = commands.add_parser("run", help="Runs the benchmarks and stores the results as JSON")
+    run_parser.add_argument("--scales", help="Comma-separated numbers of hosts and entities, default " + ",".join(map(str, SCALES)))
+    run_parser.add_argument("--functions", help="Comma-separated functions to benchmark, default all")
+    run_parser.add_argument("--repeat", type=int, default=3, help="Runs per function and scale, the median is stored")
+    run_parser.add_argument("--tags", type=int, default=5)
+    run_parser.add_argument("--management-zones", type=int, default=50)
+    run_parser.add_argument("--latency", type=float, default=0.0, help="Seconds every request is delayed by")
+    run_parser.add_argument("--output", help="JSON file the results are written to")
+    case_parser = commands.add_parser("case", help="Runs one function against a running tenant, used by run")
+    case_parser.add_argument("function", choices=FUNCTIONS)
+    case_parser.add_argument("tenant_url")
+    compare_parser = commands.add_parser("compare", help="Flags regressions of a run against a baseline")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--time-threshold", type=float, help=f"Relative wall time increase reported as a regression, default {REGRESSION_THRESHOLDS['wall_time']}")
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args)
+    elif args.command == "case":
+        print(json.dumps(run_case(args.function, args.tenant_url)))
+    elif args.command == "compare":
+        sys.exit(compare(args))
+    else:
+        parser.print_help()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+"""
+Runs LicensePluginRemote off-line against a MockTenant, without the ActiveGate plugin SDK.
+
+The ruxit.api modules the plugin imports are replaced by minimal stand-ins, the plugin keeps its state in a
+temporary directory, and the wall clock minute seen by the plugin can be chosen, so both the per-minute and
+the top-of-hour paths can be run on demand.
+
+Usage:
+python bench/harness.py --hosts 10000 --entities 10000 --minutes 5
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import types
+
+from mock_tenant import MockTenant, SyntheticTenant
+
+PLUGIN_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "custom.remote.python.license")
+
+def install_ruxit_stub():
+    """
+    Registers minimal ruxit.api.base_plugin and ruxit.api.exceptions modules, unless the real plugin SDK is installed.
+    """
+    try:
+        import ruxit.api.base_plugin # noqa: F401
+        return
+    except ImportError:
+        pass
+
+    class RemoteBasePlugin:
+        def __init__(self, config=None, activation=None, **kwargs):
+            self.config = config or {}
+            self.activation = activation
+            self.logger = logging.getLogger("license_plugin")
+
+    class ConfigException(Exception):
+        pass
+
+    modules = {name: types.ModuleType(name) for name in ("ruxit", "ruxit.api", "ruxit.api.base_plugin", "ruxit.api.exceptions")}
+    modules["ruxit"].api = modules["ruxit.api"]
+    modules["ruxit.api"].base_plugin = modules["ruxit.api.base_plugin"]
+    modules["ruxit.api"].exceptions = modules["ruxit.api.exceptions"]
+    modules["ruxit.api.base_plugin"].RemoteBasePlugin = RemoteBasePlugin
+    modules["ruxit.api.exceptions"].ConfigException = ConfigException
+    sys.modules.update(modules)
+
+def load_plugin():
+    """
+    :return: The license_plugin module, imported from the plugin directory with its bundled dependencies
+    """
+    install_ruxit_stub()
+    if PLUGIN_DIRECTORY not in sys.path:
+        sys.path.insert(0, PLUGIN_DIRECTORY)
+    import license_plugin
+    return license_plugin
+
+class PluginHarness:
+    """
+    One LicensePluginRemote instance talking to ``tenant_url``, with its state files in a temporary directory.
+
+    Parameters:
+    tenant_url(string): URL of the tenant, usually MockTenant.url.
+    token(string): API token.
+    config(dict): Additional plugin configuration.
+    """
+    def __init__(self, tenant_url, token="benchmark-token", config=None):
+        self.module = load_plugin()
+        self.directory = tempfile.mkdtemp(prefix="license_plugin_")
+        plugin_config = {"api_key": token, "tenant_id": tenant_url, "get_hu": True, "get_dem": True, "get_ddu": True}
+        plugin_config.update(config or {})
+        self.plugin = self.module.LicensePluginRemote(config=plugin_config, activation=types.SimpleNamespace(endpoint_name="benchmark"))
+        previous_tempdir = tempfile.tempdir
+        tempfile.tempdir = self.directory
+        try:
+            self.plugin.initialize()
+        finally:
+            tempfile.tempdir = previous_tempdir
+
+    def run(self, minute):
+        """
+        Runs one execution of the plugin as if the wall clock was at ``minute`` past the hour.
+
+        :return: Seconds the execution took
+        """
+        real_datetime = datetime.datetime
+
+        class FrozenDateTime(real_datetime):
+            @classmethod
+            def now(cls, tz=None):
+                return real_datetime.now(tz).replace(minute=minute)
+
+        self.module.datetime = types.SimpleNamespace(datetime=FrozenDateTime, timedelta=datetime.timedelta, timezone=datetime.timezone)
+        started = time.perf_counter()
+        try:
+            self.plugin.query()
+        finally:
+            self.module.datetime = datetime
+        return time.perf_counter() - started
+
+    def run_minute(self):
+        """
+        Runs a per-minute execution: polls the hosts and counts their host units.
+        """
+        return self.run(minute=30)
+
+    def run_hour(self):
+        """
+        Runs a top-of-hour execution, moving the last hourly push an hour back first so the hourly work is due.
+        """
+        state = self.read_state()
+        if state:
+            state["last_millis"] -= 60 * 60 * 1000
+            with open(self.plugin.tempfile, mode="w", encoding="utf-8") as f:
+                json.dump(state, f)
+        return self.run(minute=0)
+
+    def read_state(self):
+        if not os.path.isfile(self.plugin.tempfile):
+            return None
+        with open(self.plugin.tempfile, mode="r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def close(self):
+        self.plugin.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs the license plugin against a local synthetic tenant.")
+    parser.add_argument("--hosts", type=int, default=1000)
+    parser.add_argument("--entities", type=int, default=1000)
+    parser.add_argument("--applications", type=int, default=50)
+    parser.add_argument("--aws-entities", type=int, default=20)
+    parser.add_argument("--tags", type=int, default=5)
+    parser.add_argument("--management-zones", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds every request is delayed by")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Share of the requests answered with 429")
+    parser.add_argument("--minutes", type=int, default=5, help="Per-minute executions before the top-of-hour execution")
+    parser.add_argument("--verbose", action="store_true", help="Show the plugin's log")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, format="%(asctime)s %(levelname)s %(message)s")
+    tenant = SyntheticTenant(args.hosts, args.entities, args.applications, args.aws_entities, args.tags, args.management_zones)
+    with MockTenant(tenant, latency=args.latency, throttle_rate=args.throttle_rate) as mock:
+        mock.keep_lines = False
+        with PluginHarness(mock.url) as harness:
+            for minute in range(args.minutes):
+                mock.reset_stats()
+                duration = harness.run_minute()
+                print(f"Minute {minute + 1}: {duration:.2f}s, {json.dumps(mock.stats)}")
+            mock.reset_stats()
+            duration = harness.run_hour()
+            print(f"Top of the hour: {duration:.2f}s, {json.dumps(mock.stats)}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,363 @@
+"""
+Local stand-in for the parts of the Dynatrace API used by the license plugin, serving a synthetic tenant.
+
+Serves api/v2/entities with nextPageKey paging, api/v2/metrics/query, api/v2/metrics/ingest and
+api/config/v1/managementZones. Entities are generated from their index when requested, so tenants with
+hundreds of thousands of hosts and entities cost no memory up front.
+
+Usage:
+python bench/mock_tenant.py --port 8000 --hosts 10000 --entities 10000 --latency 0.05 --throttle-rate 0.01
+"""
+import argparse
+import base64
+import gzip
+import http.server
+import json
+import threading
+import time
+import urllib.parse
+
+PAGE_SIZE_MAX = 4000 # Largest page the Entities API v2 returns
+MONITORING_MODES = ("FULL_STACK", "FULL_STACK", "INFRA_ONLY")
+INGEST_MAX_AGE = 60 * 60 * 1000 # Lines with an older timestamp are rejected by the metric ingest API
+INGEST_MAX_FUTURE = 10 * 60 * 1000 # Lines with a timestamp further ahead are rejected by the metric ingest API
+
+class SyntheticTenant:
+    """
+    Deterministic synthetic tenant: the same parameters always produce the same entities and consumption.
+
+    Parameters:
+    hosts(int): Number of HOST entities.
+    entities(int): Number of SERVICE entities consuming DDUs.
+    applications(int): Number of APPLICATION entities, and of SYNTHETIC_TEST entities, consuming DEM units.
+    aws_entities(int): Number of DYNAMO_DB_TABLE and of EBS_VOLUME entities, which take their management zones from related entities.
+    tags(int): Tags per entity.
+    management_zones(int): Number of management zones, every entity is in one or two of them.
+    timeslots(int): Values per series in metric query results.
+    """
+    def __init__(self, hosts=1000, entities=1000, applications=50, aws_entities=20, tags=5, management_zones=10, timeslots=6):
+        self.counts = {
+            "HOST": hosts,
+            "SERVICE": entities,
+            "APPLICATION": applications,
+            "SYNTHETIC_TEST": applications,
+            "DYNAMO_DB_TABLE": aws_entities,
+            "AWS_AVAILABILITY_ZONE": max(aws_entities // 10, 1),
+            "EBS_VOLUME": aws_entities,
+            "EC2_INSTANCE": aws_entities
+        }
+        self.tags = tags
+        self.management_zones = max(management_zones, 1)
+        self.timeslots = timeslots
+
+    def entity_id(self, entity_type, index):
+        return f"{entity_type}-{index:016X}"
+
+    def parse_entity_id(self, entity_id):
+        """
+        :return: The type and index of ``entity_id``, or None if the tenant has no such entity
+        """
+        entity_type, _, index = entity_id.partition("-")
+        try:
+            index = int(index, 16)
+        except ValueError:
+            return None
+        if entity_type not in self.counts or index >= self.counts[entity_type]:
+            return None
+        return entity_type, index
+
+    def management_zone_names(self, index):
+        first = index % self.management_zones
+        names = [f"MZ {first}"]
+        if index % 3 == 0 and self.management_zones > 1:
+            names.append(f"MZ {(first + 1) % self.management_zones}")
+        return names
+
+    def entity(self, entity_type, index, fields):
+        """
+        Builds an entity the way the Entities API v2 returns it, with the requested ``fields``.
+        """
+        entity = {"entityId": self.entity_id(entity_type, index), "type": entity_type, "displayName": f"{entity_type.lower()}-{index}"}
+        if "tags" in fields:
+            entity["tags"] = [{"context": "CONTEXTLESS", "key": f"tag {t}", "value": f"value {(index + t) % 7}", "stringRepresentation": f"tag {t}:value {(index + t) % 7}"} for t in range(self.tags)]
+        if "managementZones" in fields and entity_type not in ("DYNAMO_DB_TABLE", "EBS_VOLUME"):
+            entity["managementZones"] = [{"id": name.split(" ")[1], "name": name} for name in self.management_zone_names(index)]
+        if "properties" in fields and entity_type == "HOST":
+            properties = {"memoryTotal": (index % 96 + 1) * 512 * 1024 * 1024, "monitoringMode": MONITORING_MODES[index % len(MONITORING_MODES)]}
+            if index % 10 == 0:
+                properties["paasMemoryLimit"] = (index % 64 + 1) * 256
+            entity["properties"] = properties
+        if "toRelationships" in fields and entity_type == "DYNAMO_DB_TABLE":
+            entity["toRelationships"] = {"isSiteOf": [{"id": self.entity_id("AWS_AVAILABILITY_ZONE", index % self.counts["AWS_AVAILABILITY_ZONE"]), "type": "AWS_AVAILABILITY_ZONE"}]}
+        if "fromRelationships" in fields and entity_type == "EBS_VOLUME":
+            entity["fromRelationships"] = {"isDiskOf": [{"id": self.entity_id("EC2_INSTANCE", index), "type": "EC2_INSTANCE"}]}
+        return entity
+
+    def values(self, index):
+        return [float((index + slot) % 5) if (index + slot) % 4 else None for slot in range(self.timeslots)]
+
+    def metric_data(self, metric_key):
+        """
+        Returns the series of a billing metric: DDUs per consuming entity, or DEM units per application and synthetic test.
+        """
+        if metric_key.startswith("builtin:billing.ddu"):
+            for entity_type in ("HOST", "SERVICE", "DYNAMO_DB_TABLE", "EBS_VOLUME"):
+                for index in range(self.counts[entity_type]):
+                    yield {"dimensions": [self.entity_id(entity_type, index)], "dimensionMap": {"dt.entity.monitored_entity": self.entity_id(entity_type, index)}, "values": self.values(index)}
+        elif metric_key.startswith("builtin:billing.synthetic"):
+            for index in range(self.counts["SYNTHETIC_TEST"]):
+                yield {"dimensions": [self.entity_id("SYNTHETIC_TEST", index)], "values": self.values(index)}
+        elif metric_key.startswith("builtin:billing.apps"):
+            for index in range(self.counts["APPLICATION"]):
+                yield {"dimensions": [self.entity_id("APPLICATION", index), "Unbilled" if index % 10 == 9 else "Billed"], "values": self.values(index)}
+
+class MockTenantHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body, headers=()):
+        data = json.dumps(body).encode("utf-8") if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in headers:
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+        self.server.mock.count(bytes_out=len(data))
+
+    def read_body(self):
+        data = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        self.server.mock.count(bytes_in=len(data))
+        if self.headers.get("Content-Encoding") == "gzip":
+            data = gzip.decompress(data)
+        return data
+
+    def handle_request(self, method):
+        mock = self.server.mock
+        url = urllib.parse.urlparse(self.path)
+        query = {key: values[0] for key, values in urllib.parse.parse_qs(url.query).items()}
+        path = url.path.strip("/")
+        body = self.read_body() if method in ("POST", "PUT") else b""
+        endpoint = "api/config/v1/managementZones/{id}" if path.startswith("api/config/v1/managementZones/") else path
+        mock.count(**{f"{method} {endpoint}": 1, "requests": 1})
+        mock.wait()
+        if mock.should_throttle():
+            mock.count(throttled=1)
+            return self.send_json(429, {"error": {"code": 429, "message": "Too Many Requests"}}, [("Retry-After", str(mock.retry_after))])
+        if query.get("Api-Token") != mock.token:
+            return self.send_json(401, {"error": {"code": 401, "message": "Missing or invalid token"}})
+        if method == "GET" and path == "api/v2/entities":
+            return self.send_json(*mock.entities(query))
+        if method == "GET" and path == "api/v2/metrics/query":
+            return self.send_json(*mock.metrics(query))
+        if method == "POST" and path == "api/v2/metrics/ingest":
+            return self.send_json(*mock.ingest(body.decode("utf-8")))
+        if path == "api/config/v1/managementZones" and method == "GET":
+            return self.send_json(200, {"values": mock.management_zone_list()})
+        if path.startswith("api/config/v1/managementZones/"):
+            if method == "GET":
+                return self.send_json(*mock.management_zone(path.split("/")[-1]))
+            if method == "PUT":
+                return self.send_json(*mock.update_management_zone(path.split("/")[-1], json.loads(body)))
+        return self.send_json(404, {"error": {"code": 404, "message": "Not found"}})
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_PUT(self):
+        self.handle_request("PUT")
+
+class MockTenant:
+    """
+    HTTP server answering like a Dynatrace tenant, see the module docstring. Use it as a context manager, or call start() and stop().
+
+    Parameters:
+    tenant(SyntheticTenant): Entities and consumption served.
+    token(string): API token the requests have to carry.
+    latency(float): Seconds every request is delayed by.
+    throttle_rate(float): Share of the requests answered with 429 Too Many Requests, spread evenly.
+    retry_after(int): Seconds sent in the Retry-After header of throttled requests.
+    port(int): Port to listen on, a free one if 0.
+    """
+    def __init__(self, tenant=None, token="benchmark-token", latency=0.0, throttle_rate=0.0, retry_after=0, port=0):
+        self.tenant = tenant or SyntheticTenant()
+        self.token = token
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.port = port
+        self.throttle_next = 0
+        self.dimensional_rules = {}
+        self.ingested_lines = []
+        self.keep_lines = True
+        self.lock = threading.Lock()
+        self.reset_stats()
+        self.server = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", self.port), MockTenantHandler)
+        self.server.daemon_threads = True
+        self.server.mock = self
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = {"requests": 0, "throttled": 0, "bytes_in": 0, "bytes_out": 0, "ingested_lines": 0}
+            self.throttle_counter = 0.0
+
+    def count(self, **counts):
+        with self.lock:
+            for key, value in counts.items():
+                self.stats[key] = self.stats.get(key, 0) + value
+
+    def throttle(self, requests):
+        """
+        Answers the next ``requests`` requests with 429 Too Many Requests.
+        """
+        with self.lock:
+            self.throttle_next += requests
+
+    def wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def should_throttle(self):
+        with self.lock:
+            if self.throttle_next > 0:
+                self.throttle_next -= 1
+                return True
+            self.throttle_counter += self.throttle_rate
+            if self.throttle_counter >= 1:
+                self.throttle_counter -= 1
+                return True
+        return False
+
+    def entities(self, query):
+        if "nextPageKey" in query:
+            try:
+                page = json.loads(base64.urlsafe_b64decode(query["nextPageKey"].encode("ascii")))
+            except ValueError:
+                return 400, {"error": {"code": 400, "message": "Invalid nextPageKey"}}
+            selector, fields, page_size, offset = page["selector"], page["fields"], page["pageSize"], page["offset"]
+        else:
+            selector = query.get("entitySelector", "")
+            fields = query.get("fields", "")
+            page_size = min(int(query.get("pageSize", 50)), PAGE_SIZE_MAX)
+            offset = 0
+        if selector.startswith("type("):
+            entity_type = selector[len("type("):].split(")")[0].strip('"')
+            ids = [(entity_type, index) for index in range(offset, min(offset + page_size, self.tenant.counts.get(entity_type, 0)))]
+            total = self.tenant.counts.get(entity_type, 0)
+        elif selector.startswith("entityId("):
+            requested = [entity_id.strip().strip('"') for entity_id in selector[len("entityId("):-1].split(",")]
+            found = [parsed for parsed in map(self.tenant.parse_entity_id, requested) if parsed]
+            ids = found[offset:offset + page_size]
+            total = len(found)
+        else:
+            return 400, {"error": {"code": 400, "message": "Unsupported entitySelector"}}
+        response = {"totalCount": total, "pageSize": page_size, "entities": [self.tenant.entity(entity_type, index, fields) for entity_type, index in ids]}
+        if offset + page_size < total:
+            page = {"selector": selector, "fields": fields, "pageSize": page_size, "offset": offset + page_size}
+            response["nextPageKey"] = base64.urlsafe_b64encode(json.dumps(page).encode("utf-8")).decode("ascii")
+        return 200, response
+
+    def metrics(self, query):
+        selectors = [selector for selector in query.get("metricSelector", "").split(",") if selector]
+        if not selectors or len(selectors) > 10:
+            return 400, {"error": {"code": 400, "message": "Between 1 and 10 metric selectors are supported"}}
+        result = [{"metricId": selector, "data": list(self.tenant.metric_data(selector))} for selector in selectors]
+        return 200, {"totalCount": sum(len(series["data"]) for series in result), "nextPageKey": None, "resolution": "1m", "result": result}
+
+    def ingest(self, payload):
+        lines = [line for line in payload.split("\n") if line.strip()]
+        now = int(time.time() * 1000)
+        valid = [line for line in lines if line.startswith("consumption.") and len(line.rsplit(" ", 2)) >= 2 and self.is_timestamp_accepted(line, now)]
+        self.count(ingested_lines=len(valid))
+        if self.keep_lines:
+            with self.lock:
+                self.ingested_lines.extend(valid)
+        invalid = len(lines) - len(valid)
+        error = {"code": 400, "message": f"{invalid} invalid lines", "invalidLines": []} if invalid else None
+        return (400 if invalid and not valid else 202), {"linesOk": len(valid), "linesInvalid": invalid, "error": error}
+
+    def is_timestamp_accepted(self, line, now):
+        """
+        :return: False if ``line`` ends with a timestamp the metric ingest API does not accept
+        """
+        parts = line.rsplit(" ", 2)
+        # The value is followed by a timestamp in milliseconds, only if there is one
+        if len(parts) < 3 or not parts[-1].isdigit() or len(parts[-1]) < 13:
+            return True
+        try:
+            float(parts[-2])
+        except ValueError:
+            return True
+        return now - INGEST_MAX_AGE <= int(parts[-1]) <= now + INGEST_MAX_FUTURE
+
+    def management_zone_list(self):
+        return [{"id": str(index), "name": f"MZ {index}"} for index in range(self.tenant.management_zones)]
+
+    def management_zone(self, mz_id):
+        if not mz_id.isdigit() or int(mz_id) >= self.tenant.management_zones:
+            return 404, {"error": {"code": 404, "message": "Management zone not found"}}
+        with self.lock:
+            dimensional_rules = list(self.dimensional_rules.get(mz_id, []))
+        return 200, {"id": mz_id, "name": f"MZ {mz_id}", "rules": [], "dimensionalRules": dimensional_rules}
+
+    def update_management_zone(self, mz_id, management_zone):
+        if not mz_id.isdigit() or int(mz_id) >= self.tenant.management_zones:
+            return 404, {"error": {"code": 404, "message": "Management zone not found"}}
+        with self.lock:
+            self.dimensional_rules[mz_id] = management_zone.get("dimensionalRules", [])
+        return 204, None
+
+def main():
+    parser = argparse.ArgumentParser(description="Serves a synthetic Dynatrace tenant for the license plugin.")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--token", default="benchmark-token")
+    parser.add_argument("--hosts", type=int, default=1000)
+    parser.add_argument("--entities", type=int, default=1000)
+    parser.add_argument("--applications", type=int, default=50)
+    parser.add_argument("--aws-entities", type=int, default=20)
+    parser.add_argument("--tags", type=int, default=5)
+    parser.add_argument("--management-zones", type=int, default=10)
+    parser.add_argument("--timeslots", type=int, default=6)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds every request is delayed by")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Share of the requests answered with 429")
+    parser.add_argument("--retry-after", type=int, default=0, help="Seconds sent in the Retry-After header of throttled requests")
+    args = parser.parse_args()
+    tenant = SyntheticTenant(args.hosts, args.entities, args.applications, args.aws_entities, args.tags, args.management_zones, args.timeslots)
+    mock = MockTenant(tenant, args.token, args.latency, args.throttle_rate, args.retry_after, args.port)
+    mock.keep_lines = False
+    mock.start()
+    print(f"Serving a synthetic tenant on {mock.url}, API token {args.token}", flush=True)
+    try:
+        while True:
+            time.sleep(60)
+            print(json.dumps(mock.stats), flush=True)
+    except KeyboardInterrupt:
+        mock.stop()
+
+if __name__ == "__main__":
+    main()
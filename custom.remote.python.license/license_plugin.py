@@ -4,15 +4,29 @@ TODO: DDU tags, don't use Host V1 API
 """
 
 import json
+import contextlib
+import email.utils
+import functools
+import gzip
 import logging
+import queue
+import random
 import re
 import requests
+import socket
+import sys
 import tempfile
+import threading
 import time
 import urllib
+import uuid
 import re
 from multiprocessing.pool import ThreadPool
 import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from bisect import bisect_right
 from math import ceil
 import datetime
 
@@ -26,6 +40,284 @@ ENTITY_ENDPOINT = "api/v2/entities"
 METRIC_ENDPOINT = "api/v2/metrics/query"
 METRIC_INGEST_ENDPOINT = "api/v2/metrics/ingest"
 MZ_ENDPOINT = "api/config/v1/managementZones"
+HTTP_POOL_CONNECTIONS = 4 # Number of per-host connection pools kept by the session
+HTTP_POOL_MAXSIZE = 10 # Connections kept open to a single host
+HTTP_CONNECT_TIMEOUT = 10 # Longest wait in seconds for a pooled or new connection, shortened to what is left of the execution's time
+HTTP_READ_TIMEOUT = 60 # Longest wait in seconds for a response, shortened to what is left of the execution's time
+DEM_QUERY_WORKERS = 6 # DEM billing metrics queried at the same time
+METRIC_SELECTORS_PER_QUERY = 10 # Maximum number of comma-separated metric selectors the Metrics API v2 accepts
+ENTITY_LOOKUP_WORKERS = 4 # Entity ID chunks looked up at the same time
+ENTITY_IDS_PER_LOOKUP = 100 # Entity IDs per entityId(...) selector, keeps the URL well below common length limits
+RELATIONSHIP_ENTITY_TYPES = ("DYNAMO_DB_TABLE", "EBS_VOLUME") # Take their management zones from a related entity, see add_entities
+ENTITY_CACHE_TTL = 24 # Hours an entity definition is reused from the entity cache before it is looked up again
+PAGE_PREFETCH = 1 # Entity pages fetched ahead while the current page is processed, 0 fetches pages one after another
+REQUEST_BUDGET = 10000 # API calls, retries included, one execution may make
+REQUEST_TIME_BUDGET = 45 # Seconds after which an execution stops making API calls, must stay below the one minute polling interval
+MAX_RETRIES = 5 # Retries of a throttled or failed API call
+RETRY_BACKOFF = 1 # Seconds waited before the first retry, doubled on every retry
+RETRY_BACKOFF_MAX = 60 # Longest wait between two retries
+RETRY_STATUS_CODES = (429, 502, 503, 504)
+INGEST_MAX_LINES = 1000 # Metric lines per ingest request
+INGEST_MAX_BYTES = 1000000 # Ingest request body size, the API rejects payloads above 1 MB
+INGEST_MAX_DIMENSIONS = 50000 # Dimension values over all lines of one ingest request
+INGEST_WORKERS = 4 # Ingest requests sent at the same time
+INGEST_COMPRESSION_LEVEL = 6 # gzip level of ingest request bodies, 0 sends them uncompressed
+SPOOL_MAX_SIZE = 50 # MB of unsent ingest batches kept on disk, the oldest are dropped beyond it
+SPOOL_MAX_AGE = 72 # Hours an unsent ingest batch is retried before it is dropped
+SPOOL_RETRY_BACKOFF = 60 # Seconds before a spooled batch is retried the first time, doubled on every failed retry
+SPOOL_REPLAY_TIME_BUDGET = 10 # Seconds per execution spent replaying spooled batches, after the HU poll and the hourly work
+SPOOL_RETRY_BACKOFF_MAX = 60 * 60
+WORK_PRIORITY = ("DEM", "DDU", "HU", "MZ rules", "Prefetch", "Backfill") # Hourly work, most important first
+BACKFILL_MAX_AGE = 14 * 24 # Hours of DEM and DDU consumption missed during a downtime that are backfilled, the Metrics API keeps minute resolution for 14 days
+BACKFILLED_METRIC_SUFFIX = ".backfilled" # Appended to the metric keys of consumption pushed after its hour, so sums of the live keys are not skewed
+BACKFILL_TIME_BUDGET = 30 # Seconds per execution spent on backfilling missed hours
+SELF_MONITORING_METRICS = { # Counted per phase of an execution and pushed with the phase as dimension
+    "duration": "consumption.plugin.duration",
+    "requests": "consumption.plugin.requests",
+    "retries": "consumption.plugin.retries",
+    "throttled": "consumption.plugin.throttled",
+    "bytes": "consumption.plugin.bytes",
+    "pages": "consumption.plugin.pages",
+    "entities": "consumption.plugin.entities",
+    "lines": "consumption.plugin.lines",
+    "invalid_lines": "consumption.plugin.invalidLines",
+    "failures": "consumption.plugin.failures"
+}
+PREFETCH_MINUTE = 45 # Minutes into the hour after which entities are prefetched and management zone rules checked for the next hourly push
+WORK_MAX_AGE = 24 # Hours unfinished hourly work is carried over before it is dropped
+
+# DEM billing metrics and how much a value of 1 needs to be multiplied by to get DEM units
+DEM_RUM_METRICS = {
+    "builtin:billing.apps.web.sessionsWithoutReplayByApplication": 0.25,
+    "builtin:billing.apps.web.sessionsWithReplayByApplication": 1,
+    "builtin:billing.apps.web.userActionPropertiesByApplication": 0.01,
+    "builtin:billing.apps.custom.sessionsWithoutReplayByApplication": 0.25,
+    "builtin:billing.apps.custom.userActionPropertiesByDeviceApplication": 0.01,
+    "builtin:billing.apps.mobile.sessionsWithoutReplayByApplication": 0.25,
+    "builtin:billing.apps.mobile.userActionPropertiesByMobileApplication": 0.01,
+    "builtin:billing.apps.mobile.sessionsWithReplayByApplication": 1
+}
+DEM_SYNTHETIC_METRICS = {
+    "builtin:billing.synthetic.actions": 1,
+    "builtin:billing.synthetic.requests": 0.1,
+    "builtin:billing.synthetic.external": 0.1
+}
+
+class DeadlineTimeout(urllib3.util.Timeout):
+    """
+    urllib3 Timeout shortened to what is left until ``deadline`` whenever urllib3 reads it,
+    so the time spent waiting for a pooled connection counts as well.
+
+    Parameters:
+    deadline(float): Time, in seconds since the epoch, after which nothing is waited for.
+    connect(float): Longest wait for a pooled or new connection.
+    read(float): Longest wait for data from the server.
+    """
+
+    def __init__(self, deadline, connect=None, read=None):
+        self.deadline = deadline
+        super().__init__(connect=connect, read=read)
+
+    def clone(self):
+        return DeadlineTimeout(self.deadline, connect=self._connect, read=self._read)
+
+    def remaining(self, timeout):
+        # A zero timeout would turn the socket non-blocking, so an expired deadline times out right away instead
+        return max(min(timeout, self.deadline - time.time()), 0.001)
+
+    @property
+    def connect_timeout(self):
+        return self.remaining(self._connect)
+
+    @property
+    def read_timeout(self):
+        return self.remaining(self._read)
+
+class DeadlineConnectionPoolMixin:
+    """
+    Waits for a free connection of a full pool no longer than the connect timeout of the request.
+    The session's pools block once all their connections are in use, and urllib3 would otherwise wait forever.
+    """
+
+    def urlopen(self, method, url, *args, **kwargs):
+        timeout = kwargs.get("timeout")
+        if kwargs.get("pool_timeout") is None and isinstance(timeout, DeadlineTimeout):
+            kwargs["pool_timeout"] = timeout.connect_timeout
+        return super().urlopen(method, url, *args, **kwargs)
+
+class DeadlineHTTPConnectionPool(DeadlineConnectionPoolMixin, HTTPConnectionPool):
+    pass
+
+class DeadlineHTTPSConnectionPool(DeadlineConnectionPoolMixin, HTTPSConnectionPool):
+    pass
+
+class PooledHTTPAdapter(HTTPAdapter):
+    """
+    HTTPAdapter keeping idle connections to the tenant open between plugin executions.
+    Also reports how many requests went over an already established connection.
+    """
+
+    def __init__(self, keep_alive=True, **kwargs):
+        self.keep_alive = keep_alive
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.keep_alive:
+            # Let the OS probe idle pooled sockets so half-closed connections are detected before reuse
+            kwargs["socket_options"] = HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": DeadlineHTTPConnectionPool, "https": DeadlineHTTPSConnectionPool}
+
+    def connection_stats(self):
+        """
+        Sums the urllib3 counters of all live connection pools.
+
+        :return: dict with the number of requests, newly opened connections and reused connections
+        """
+        stats = {"requests": 0, "connections": 0}
+        pools = self.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                stats["requests"] += pool.num_requests
+                stats["connections"] += pool.num_connections
+        stats["reused"] = max(stats["requests"] - stats["connections"], 0)
+        return stats
+
+TAG_KEY_PATTERN = re.compile("[^0-9a-z_-]")
+TAG_KEY_CACHE_SIZE = 4096 # Distinct tag keys remembered by normalize_tag_key
+TAG_VALUE_CACHE_SIZE = 65536 # Distinct tag values remembered by escape_tag_value
+
+@functools.lru_cache(maxsize=TAG_KEY_CACHE_SIZE)
+def normalize_tag_key(key, strip_quotes=False):
+    """
+    Turns a tag key into a valid metric dimension key: no spaces, lowercase, only digits, letters, ``_`` and ``-``, at most 100 characters.
+
+    :param key: Tag key as returned by the API
+    :param strip_quotes: Remove quotes before truncating, as done for host tags. Entity tags are truncated first.
+    :return: The dimension key
+    """
+    key = key.replace(" ", "").lower()
+    if strip_quotes:
+        key = key.replace("\'", "").replace("\"", "")
+    return sys.intern(TAG_KEY_PATTERN.sub("", key[:100]))
+
+@functools.lru_cache(maxsize=TAG_VALUE_CACHE_SIZE)
+def escape_tag_value(value):
+    """
+    Truncates a tag value to 250 characters and escapes its quotes so it can be used as a quoted dimension value.
+    """
+    return sys.intern(value[:250].replace("\"", "\\\"").replace("'", "\\'"))
+
+MANAGEMENT_ZONES = {}
+
+def intern_management_zones(management_zones):
+    """
+    Returns the names of ``management_zones`` as a tuple shared by every entity in the same management zones.
+
+    :param management_zones: Management zones as returned by the API, or their names
+    :return: Tuple of interned management zone names, ``Undefined`` for zones without a name
+    """
+    names = tuple(sys.intern(mz if isinstance(mz, str) else mz.get('name', 'Undefined')) for mz in management_zones)
+    return MANAGEMENT_ZONES.setdefault(names, names)
+
+class EntityDefinition:
+    """
+    Name, tags and management zones of an entity, used to attribute consumption to it.
+    """
+    __slots__ = ("name", "tags", "mz")
+
+    def __init__(self, name, tags, mz):
+        self.name = name
+        self.tags = tags
+        self.mz = mz
+
+class RequestBudgetExceeded(RuntimeError):
+    """
+    Raised when an execution ran out of API calls or time, the remaining work is left for the next execution.
+    """
+
+class IngestBatcher:
+    """
+    Collects metric ingest lines and hands them to ``push`` in batches staying within the ingest API limits.
+    A batch is pushed as soon as one more line would exceed the line count, byte size or dimension limit.
+    With more than one worker, batches are pushed from a thread pool while the next batch is being built.
+    Use it as a context manager so the last batch is pushed on exit and ``done`` receives the results of all batches, in batch order.
+    """
+
+    def __init__(self, push, max_lines=INGEST_MAX_LINES, max_bytes=INGEST_MAX_BYTES, max_dimensions=INGEST_MAX_DIMENSIONS, workers=1, done=None):
+        self.push = push
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+        self.max_dimensions = max_dimensions
+        self.done = done
+        self.lines = []
+        self.bytes = 0
+        self.dimensions = 0
+        self.total_lines = 0
+        self.results = []
+        self.pool = ThreadPool(processes = workers) if workers > 1 else None
+        # Bounds the batches built but not sent yet, so a slow tenant does not let them pile up in memory
+        self.pending = threading.BoundedSemaphore(workers * 2)
+
+    def add(self, line, dimensions=0):
+        """
+        Adds one metric line, ``dimensions`` being the number of dimensions it carries.
+        """
+        line_bytes = len(line.encode('utf-8')) + 1 # Lines are separated by a newline
+        if self.lines and (len(self.lines) >= self.max_lines or self.bytes + line_bytes > self.max_bytes or self.dimensions + dimensions > self.max_dimensions):
+            self.flush()
+        self.lines.append(line)
+        self.bytes += line_bytes
+        self.dimensions += dimensions
+        self.total_lines += 1
+
+    def flush(self):
+        if self.lines:
+            payload = "\n".join(self.lines)
+            if self.pool:
+                self.pending.acquire()
+                release = lambda _: self.pending.release()
+                self.results.append(self.pool.apply_async(self.push, (payload,), callback=release, error_callback=release))
+            else:
+                self.results.append(self.push(payload))
+        self.lines = []
+        self.bytes = 0
+        self.dimensions = 0
+
+    def close(self):
+        """
+        Pushes the last batch and waits for all batches to be sent.
+
+        :return: The value ``push`` returned for every batch, in batch order
+        :raises Exception: The first error raised by ``push``, once all batches are done
+        """
+        self.flush()
+        results = self.results
+        error = None
+        if self.pool:
+            self.pool.close()
+            results = []
+            for async_result in self.results:
+                try:
+                    results.append(async_result.get())
+                except Exception as e:
+                    results.append(None)
+                    error = error or e
+        if self.done:
+            self.done(results)
+        if error:
+            raise error
+        return results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self.pool:
+            self.pool.close()
 
 class LicensePluginRemote(RemoteBasePlugin):
 
@@ -38,11 +330,75 @@ class LicensePluginRemote(RemoteBasePlugin):
             raise ConfigException("Please enter a valid API token")
         self.tenant_id = self.config.get("tenant_id").strip().rstrip("/")
         self.tempfile = tempfile.gettempdir() + '/' + "".join([c for c in self.activation.endpoint_name if re.match(r'\w', c)]) + ".dt"
+        self.entity_cache_file = os.path.splitext(self.tempfile)[0] + ".entities.dt"
+        self.host_metadata_file = os.path.splitext(self.tempfile)[0] + ".hosts.dt"
+        self.host_metadata = None
+        self.host_fingerprints = {}
+        self.work_file = os.path.splitext(self.tempfile)[0] + ".work.dt"
+        self.scheduled_work = None
+        prefetch_minute = self.config.get("prefetch_minute")
+        self.prefetch_minute = int(PREFETCH_MINUTE if prefetch_minute is None else prefetch_minute)
+        if not 0 <= self.prefetch_minute <= 58:
+            raise ConfigException("The prefetch minute has to be between 0 and 58, the prefetch runs before the next hourly push")
+        backfill_time_budget = self.config.get("backfill_time_budget")
+        self.backfill_time_budget = float(BACKFILL_TIME_BUDGET if backfill_time_budget is None else backfill_time_budget)
+        self.self_monitoring = self.config.get("self_monitoring", False)
+        self.spool_directory = os.path.splitext(self.tempfile)[0] + ".spool"
+        spool_max_size = self.config.get("spool_max_size")
+        self.spool_max_size = float(SPOOL_MAX_SIZE if spool_max_size is None else spool_max_size) * 1024 * 1024
+        spool_max_age = self.config.get("spool_max_age")
+        self.spool_max_age = float(SPOOL_MAX_AGE if spool_max_age is None else spool_max_age) * 60 * 60 * 1000
+        entity_cache_ttl = self.config.get("entity_cache_ttl")
+        self.entity_cache_ttl = float(ENTITY_CACHE_TTL if entity_cache_ttl is None else entity_cache_ttl) * 60 * 60 * 1000
         self.get_hu = self.config.get("get_hu", True)
         self.get_ddu = self.config.get("get_ddu", True)
         self.get_dem = self.config.get("get_dem", True)
+        dem_query_workers = self.config.get("dem_query_workers")
+        self.dem_query_workers = max(int(DEM_QUERY_WORKERS if dem_query_workers is None else dem_query_workers), 1)
+        self.dem_batch_queries = self.config.get("dem_batch_queries", True)
+        entity_lookup_workers = self.config.get("entity_lookup_workers")
+        self.entity_lookup_workers = max(int(ENTITY_LOOKUP_WORKERS if entity_lookup_workers is None else entity_lookup_workers), 1)
+        page_prefetch = self.config.get("page_prefetch")
+        self.page_prefetch = int(PAGE_PREFETCH if page_prefetch is None else page_prefetch)
+        ingest_workers = self.config.get("ingest_workers")
+        self.ingest_workers = max(int(INGEST_WORKERS if ingest_workers is None else ingest_workers), 0)
+        ingest_compression_level = self.config.get("ingest_compression_level")
+        self.ingest_compression_level = int(INGEST_COMPRESSION_LEVEL if ingest_compression_level is None else ingest_compression_level)
+        request_budget = self.config.get("request_budget")
+        self.request_budget = int(REQUEST_BUDGET if request_budget is None else request_budget)
+        request_time_budget = self.config.get("request_time_budget")
+        self.request_time_budget = float(REQUEST_TIME_BUDGET if request_time_budget is None else request_time_budget)
+        self.request_stats_lock = threading.Lock()
+        self.request_stats = dict.fromkeys(SELF_MONITORING_METRICS, 0)
+        self.phase_stats = []
         logger.info(f"Using tempfile: {self.tempfile}")
+        logger.info(f"Using entity cache: {self.entity_cache_file}")
+        logger.info(f"Using ingest spool: {self.spool_directory}")
+        os.makedirs(self.spool_directory, exist_ok=True)
         urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+        self.session = self.create_session()
+
+    def create_session(self):
+        """
+        Creates the HTTP session shared by every API call of the plugin, so TCP and TLS handshakes to the tenant are reused across calls and executions.
+        """
+        http_pool_connections = self.config.get("http_pool_connections")
+        pool_connections = max(int(HTTP_POOL_CONNECTIONS if http_pool_connections is None else http_pool_connections), 1)
+        http_pool_maxsize = self.config.get("http_pool_maxsize")
+        pool_maxsize = max(int(HTTP_POOL_MAXSIZE if http_pool_maxsize is None else http_pool_maxsize), 1)
+        keep_alive = self.config.get("http_keep_alive", True)
+        self.adapter = PooledHTTPAdapter(keep_alive=keep_alive, pool_connections=pool_connections, pool_maxsize=pool_maxsize, pool_block=True)
+        session = requests.Session()
+        session.verify = False
+        session.mount("https://", self.adapter)
+        session.mount("http://", self.adapter)
+        if not keep_alive:
+            session.headers["Connection"] = "close"
+        logger.info(f"Using HTTP session with {pool_connections} pools of {pool_maxsize} connections, keep-alive: {keep_alive}")
+        return session
+
+    def close(self, **kwargs):
+        self.session.close()
 
     def query(self, **kwargs):
         """
@@ -50,119 +406,674 @@ class LicensePluginRemote(RemoteBasePlugin):
         Called each and every execution of the plugin.
         """
         cache = {}
+        started = time.time()
         self.current_millis = int(time.time() * 1000)
-        if os.path.isfile(f'{self.tempfile}') and os.path.getsize(f'{self.tempfile}'):
-            try:
-                data = ""
-                with open(f'{self.tempfile}', mode='r', encoding="utf-8") as f:
-                    data = f.read()
-                jsonData = json.loads(data)
-                self.last_millis = jsonData["last_millis"]
-                cache["hosts"] = jsonData["hosts"]
-            except Exception as e:
-                self.logger.exception(e)
-                self.logger.warning(data)
-                cache["hosts"] = {}
-                self.last_millis = self.current_millis
+        self.request_deadline = time.time() + self.request_time_budget
+        connections_before = self.adapter.connection_stats()
+        with self.request_stats_lock:
+            self.request_stats = dict.fromkeys(SELF_MONITORING_METRICS, 0)
+        self.phase_stats = []
+        jsonData = self.read_state_file(self.tempfile, ("last_millis", "hosts"))
+        if jsonData:
+            self.last_millis = jsonData["last_millis"]
+            cache["hosts"] = self.load_hosts(jsonData["hosts"])
         else:
-            cache["hosts"] = {}
+            cache["hosts"] = self.load_hosts({})
             self.last_millis = self.current_millis
         time_elapsed = self.current_millis - self.last_millis
         if time_elapsed > 24 * 60 * 60 * 1000: # Cap it at 24 hours to hopefully not run out of time executing the API calls
             time_elapsed = 24 * 60 * 60 * 1000
+            missed_millis = self.last_millis
             self.last_millis = self.current_millis - 24 * 60 * 60 * 1000
+            # The DEM and DDU consumption before the last 24 hours is backfilled hour by hour in the next executions
+            self.schedule_backfill(max(missed_millis, self.current_millis - BACKFILL_MAX_AGE * 60 * 60 * 1000), self.last_millis)
         self.logger.info(f"Current milliseconds: {self.current_millis}")
         self.logger.info(f"Last milliseconds: {self.last_millis}")
         self.logger.info(f"Time elapsed: {time_elapsed}")
         now = datetime.datetime.now()
         if time_elapsed >= 59 * 60 * 1000 and now.minute == 0: # Send data once per hour
-            resetStats = {}
-            resetStats["last_millis"] = self.current_millis
-            resetStats["hosts"] = {}
-            result = json.dumps(resetStats)
-            with open(f"{self.tempfile}", mode="w", encoding="utf-8") as f:
-                f.write(result)
-            entity_definitions = {}
-            if self.get_dem:
-                self.logger.info(f"Calculating DEM...")
-                self.calculate_and_push_consumption_for_dem(entity_definitions)
-            if self.get_ddu:
-                self.logger.info(f"Calculating DDU...")
-                self.calculate_and_push_consumption_for_ddu(entity_definitions, cache["hosts"])
-            if self.get_hu:
-                self.logger.info(f"Pushing HU and HU hours...")
-                self.push_consumption_for_host_units(cache["hosts"])
-            if self.get_ddu:
-                self.logger.info(f"Checking management zone rules...")
-                self.add_management_zone_rule()
-                self.logger.info(f"Done with management zone rules.")
+            self.prune_host_metadata(cache["hosts"])
+            # The hour's counters are only reset once the work pushing them is persisted, so a crash in between loses nothing
+            self.schedule_hourly_work(self.last_millis, self.current_millis, cache["hosts"])
+            self.save_hosts(self.current_millis, {})
+            self.run_scheduled_work()
         else:
             if self.get_hu:
                 self.logger.info(f"Getting hosts and checking HU hours...")
-                self.get_consumption_for_host_units(cache["hosts"])
-                self.logger.info(f"Got hosts and checked HU hours.")
-            cache["last_millis"] = self.last_millis
-            result = json.dumps(cache)
-            with open(f"{self.tempfile}", mode="w", encoding="utf-8") as f:
-                f.write(result)
-            
+                try:
+                    with self.phase("HU poll"):
+                        self.get_consumption_for_host_units(cache["hosts"])
+                    self.logger.info(f"Got hosts and checked HU hours.")
+                except RequestBudgetExceeded as e:
+                    self.logger.warning(f"Stopped checking HU hours, the remaining hosts are checked next execution: {e}")
+            self.save_hosts(self.last_millis, cache["hosts"])
+            self.run_scheduled_work()
+        # Replayed last, so unsent batches of earlier executions never starve the HU poll and the hourly work
+        try:
+            with self.phase("Replay"):
+                self.replay_spooled_batches()
+        except RequestBudgetExceeded as e:
+            self.logger.warning(f"Stopped replaying unsent ingest batches: {e}")
+        except Exception as e:
+            self.logger.exception(f"Failed replaying unsent ingest batches: {e}")
+        connections = self.adapter.connection_stats()
+        self.logger.info(f"HTTP requests: {connections['requests'] - connections_before['requests']}, new connections: {connections['connections'] - connections_before['connections']}, reused connections: {connections['reused'] - connections_before['reused']}")
+        self.logger.info(f"API calls: {self.request_stats['requests']}, retries: {self.request_stats['retries']}, throttled: {self.request_stats['throttled']}")
+        if self.self_monitoring:
+            self.phase_stats.append(("Execution", dict(self.request_stats, duration=time.time() - started)))
+            self.push_self_monitoring()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Times the code run in the with block and counts the API calls, bytes, entity pages, entities and ingest lines it used,
+        as well as whether it failed, for the self-monitoring metrics.
+
+        Parameters:
+        name(string): Phase the numbers are pushed for.
+        """
+        with self.request_stats_lock:
+            before = dict(self.request_stats)
+        started = time.time()
+        failed = False
+        try:
+            yield
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            with self.request_stats_lock:
+                stats = {key: value - before[key] for key, value in self.request_stats.items()}
+            stats["duration"] = time.time() - started
+            stats["failures"] += failed
+            self.phase_stats.append((name, stats))
+
+    def count(self, **counts):
+        """
+        Adds to the counters of this execution, see ``SELF_MONITORING_METRICS``.
+        """
+        with self.request_stats_lock:
+            for key, value in counts.items():
+                self.request_stats[key] += value
+
+    def push_self_monitoring(self):
+        """
+        Pushes how long each phase of this execution took and what it used as consumption.plugin.* metrics.
+        Only non-zero counters are pushed, since every data point is billed as DDUs.
+        The push itself is not counted, and a failed push never fails the execution.
+        """
+        try:
+            with self.ingest_batcher("self-monitoring") as batcher:
+                for name, stats in self.phase_stats:
+                    for key, metric in SELF_MONITORING_METRICS.items():
+                        value = round(stats[key], 3) if key == "duration" else stats[key]
+                        if value:
+                            batcher.add(f'{metric},phase="{name}" {value}', 1)
+        except Exception as e:
+            self.logger.warning(f"Could not push self-monitoring metrics: {e}")
+        self.phase_stats = []
+
+    def schedule_hourly_work(self, from_millis, to_millis, hosts):
+        """
+        Adds the enabled hourly work for the hour between ``from_millis`` and ``to_millis`` to the scheduled work.
+
+        Parameters:
+        hosts(dict): Host tracking cache of the hour, its counters are kept to push HU and HU hours.
+        """
+        work = []
+        if self.get_dem:
+            work.append({"work": "DEM", "from": from_millis, "to": to_millis})
+        if self.get_ddu:
+            work.append({"work": "DDU", "from": from_millis, "to": to_millis})
+        if self.get_hu:
+            counters = {host_id: [host["seen"], host["hu"]] for host_id, host in hosts.items()}
+            work.append({"work": "HU", "from": from_millis, "to": to_millis, "hosts": counters})
+        if self.get_dem or self.get_ddu:
+            # Done in a quiet minute of the next hour, so the next hourly push mostly finds its entities in the entity cache
+            work.append({"work": "Prefetch", "from": to_millis, "to": to_millis + 59 * 60 * 1000, "after": to_millis + self.prefetch_minute * 60 * 1000})
+        self.save_scheduled_work(self.load_scheduled_work() + work)
+
+    def schedule_backfill(self, from_millis, to_millis):
+        """
+        Schedules the DEM and DDU consumption between ``from_millis`` and ``to_millis`` to be backfilled, extending the backfill it directly follows.
+        """
+        if from_millis >= to_millis or not (self.get_dem or self.get_ddu):
+            return
+        scheduled_work = self.load_scheduled_work()
+        for item in scheduled_work:
+            if item["work"] == "Backfill" and item["to"] == from_millis:
+                item["to"] = to_millis
+                break
+        else:
+            scheduled_work = scheduled_work + [{"work": "Backfill", "from": from_millis, "to": to_millis, "done": []}]
+            self.logger.warning(f"Missed consumption since {datetime.datetime.fromtimestamp(from_millis / 1000):%Y-%m-%d %H:%M}, backfilling it hour by hour")
+        self.write_state_file(self.work_file, json.dumps({"work": scheduled_work}))
+        self.scheduled_work = scheduled_work
+
+    def run_scheduled_work(self):
+        """
+        Runs the scheduled hourly work by priority, oldest hour first, until the execution runs out of API calls or time.
+        Work that could not be finished is kept for the next execution and dropped once it is older than ``WORK_MAX_AGE``.
+        Every item is removed from the work file as soon as it is done, so a crash later in the execution never runs it again.
+        """
+        scheduled_work = sorted(self.load_scheduled_work(), key=lambda item: (WORK_PRIORITY.index(item["work"]), item["to"]))
+        if not scheduled_work:
+            return
+        entity_definitions = None
+        unfinished = []
+        for item in scheduled_work:
+            description = self.describe_work_item(item)
+            if item["work"] == "Prefetch" and self.current_millis >= item["to"]:
+                if not self.get_ddu:
+                    self.logger.info(f"Skipping {description}, the hourly push is due")
+                    self.finish_work_item(item)
+                    continue
+                # The hourly push looks up its entities itself, but the management zone rules are only checked by the prefetch
+                self.logger.info(f"Skipping {description}, the hourly push is due, only checking management zone rules")
+                mz_rules = {"work": "MZ rules", "from": item["from"], "to": item["to"]}
+                self.scheduled_work = [mz_rules if other is item else other for other in self.scheduled_work]
+                item = mz_rules
+                description = self.describe_work_item(item)
+            if item["work"] != "Backfill" and self.current_millis - item["to"] > WORK_MAX_AGE * 60 * 60 * 1000:
+                self.logger.warning(f"Dropping {description}, it could not be finished for {WORK_MAX_AGE} hours")
+                self.finish_work_item(item)
+                continue
+            if self.current_millis < item.get("after", 0):
+                continue
+            if time.time() > self.request_deadline or self.request_stats["requests"] >= self.request_budget:
+                unfinished.append(item)
+                continue
+            if item["work"] in ("DEM", "DDU", "Prefetch", "Backfill") and entity_definitions is None:
+                entity_definitions = self.load_entity_cache()
+                self.fetched_entity_types = set()
+                self.missing_entities = set()
+            try:
+                with self.phase("HU push" if item["work"] == "HU" else item["work"]):
+                    if self.run_work_item(item, entity_definitions):
+                        self.finish_work_item(item)
+            except RequestBudgetExceeded as e:
+                self.logger.warning(f"Stopped {description}: {e}")
+                unfinished.append(item)
+            except Exception as e:
+                self.logger.exception(f"Failed {description}: {e}")
+                unfinished.append(item)
+        if entity_definitions is not None:
+            self.save_entity_cache(entity_definitions)
+        if unfinished:
+            self.logger.warning(f"Carrying over {len(unfinished)} unfinished work items to the next execution: " + ", ".join(self.describe_work_item(item) for item in unfinished))
+
+    def finish_work_item(self, item):
+        """
+        Removes a done or dropped item from the scheduled work and writes the remaining work to disk right away.
+        """
+        self.scheduled_work = [other for other in self.scheduled_work if other is not item]
+        self.write_state_file(self.work_file, json.dumps({"work": self.scheduled_work}))
+
+    def describe_work_item(self, item):
+        if item["work"] == "Backfill":
+            return f'Backfill from {datetime.datetime.fromtimestamp(item["from"] / 1000):%Y-%m-%d %H:%M} to {datetime.datetime.fromtimestamp(item["to"] / 1000):%Y-%m-%d %H:%M}'
+        return f'{item["work"]} of the hour ending {datetime.datetime.fromtimestamp(item["to"] / 1000):%Y-%m-%d %H:%M}'
+
+    def run_work_item(self, item, entity_definitions):
+        """
+        Runs one item of hourly work, see ``schedule_hourly_work``.
+
+        :return: False if the item was only partly done and continues next execution
+        """
+        # Carried over past the next hourly push, the consumption would be added to that hour's, so it is pushed like backfilled consumption
+        backfilled_hour = self.format_backfilled_hour(item["to"]) if self.current_millis - item["to"] >= 60 * 60 * 1000 else None
+        if item["work"] == "DEM":
+            self.logger.info(f"Calculating DEM...")
+            self.calculate_and_push_consumption_for_dem(entity_definitions, item["from"], item["to"], backfilled_hour=backfilled_hour)
+        elif item["work"] == "DDU":
+            self.logger.info(f"Calculating DDU...")
+            self.calculate_and_push_consumption_for_ddu(entity_definitions, self.host_metadata, item["from"], item["to"], backfilled_hour=backfilled_hour)
+        elif item["work"] == "HU":
+            self.logger.info(f"Pushing HU and HU hours...")
+            self.push_consumption_for_host_units(self.load_hosts(item["hosts"]), backfilled_hour=backfilled_hour)
+        elif item["work"] == "MZ rules":
+            self.logger.info(f"Checking management zone rules...")
+            self.add_management_zone_rule()
+            self.logger.info(f"Done with management zone rules.")
+        elif item["work"] == "Prefetch":
+            self.prefetch_hourly_work(entity_definitions, item["from"])
+        elif item["work"] == "Backfill":
+            return self.backfill(entity_definitions, item)
+        return True
+
+    def backfill(self, entity_definitions, item):
+        """
+        Pushes the DEM and DDU consumption of the missed hours of a Backfill item, oldest first, for up to ``backfill_time_budget`` seconds.
+        The metric ingest API rejects lines older than an hour, so the data cannot land in its original hour. It is pushed at the current time to the
+        backfilled metric keys, e.g. consumption.DDU.backfilled, with the end of its hour as backfilled_hour dimension, and the progress is written to the scheduled work after every step so no hour is pushed twice.
+
+        Parameters:
+        entity_definitions(dict): Contains all entities in order to link consumption to applications.
+        item(dict): Backfill item, its ``from`` is moved forward as hours are pushed.
+
+        :return: True once all missed hours were pushed
+        """
+        started = time.time()
+        while item["from"] < item["to"] and time.time() - started < self.backfill_time_budget:
+            window_end = min(item["from"] + 60 * 60 * 1000, item["to"])
+            # Until the next hourly push, every execution moves the 24 hour cap and extends the backfill, so its last hour is not complete yet
+            if window_end - item["from"] < 60 * 60 * 1000 and item["to"] >= self.last_millis:
+                break
+            self.logger.info(f"Backfilling the hour ending {datetime.datetime.fromtimestamp(window_end / 1000):%Y-%m-%d %H:%M}...")
+            backfilled_hour = self.format_backfilled_hour(window_end)
+            if self.get_dem and "DEM" not in item["done"]:
+                self.calculate_and_push_consumption_for_dem(entity_definitions, item["from"], window_end, backfilled_hour=backfilled_hour)
+                item["done"].append("DEM")
+                self.write_state_file(self.work_file, json.dumps({"work": self.scheduled_work}))
+            if self.get_ddu and "DDU" not in item["done"]:
+                self.calculate_and_push_consumption_for_ddu(entity_definitions, self.host_metadata, item["from"], window_end, backfilled_hour=backfilled_hour)
+                item["done"].append("DDU")
+            item["from"] = window_end
+            item["done"] = []
+            self.write_state_file(self.work_file, json.dumps({"work": self.scheduled_work}))
+        if item["from"] < item["to"]:
+            self.logger.info(f"{(item['to'] - item['from']) / (60 * 60 * 1000):.1f} hours left to backfill")
+            return False
+        self.logger.info(f"Done backfilling")
+        return True
+
+    def format_backfilled_hour(self, millis):
+        """
+        :return: The backfilled_hour dimension value of the hour ending at ``millis``, in UTC
+        """
+        return f"{datetime.datetime.fromtimestamp(millis / 1000, tz=datetime.timezone.utc):%Y-%m-%dT%H:%MZ}"
+
+    def prefetch_hourly_work(self, entity_definitions, from_millis):
+        """
+        Does the slow part of the next hourly push ahead of time: looks up the entities consuming DEM and DDU so far this hour and checks the management zone rules.
+        The hourly push then only queries the consumption of the whole hour, pushes it and the HU and HU hours.
+
+        Parameters:
+        entity_definitions(dict): Entity definitions the looked up entities are added to, stored in the entity cache afterwards.
+        from_millis(int): Start of the hour.
+        """
+        to_millis = int(time.time() * 1000)
+        if self.get_dem:
+            self.logger.info(f"Prefetching DEM applications...")
+            self.query_dem_metrics(entity_definitions, from_millis - 60 * 60 * 1000, to_millis - 60 * 60 * 1000)
+        if self.get_ddu:
+            self.logger.info(f"Prefetching DDU entities...")
+            self.query_ddu_metric(entity_definitions, self.host_metadata, from_millis - 180000, to_millis - 180000)
+            self.logger.info(f"Checking management zone rules...")
+            self.add_management_zone_rule()
+            self.logger.info(f"Done with management zone rules.")
+
+    def load_scheduled_work(self):
+        """
+        Returns the scheduled hourly work, read from disk after a restart.
+        """
+        if self.scheduled_work is None:
+            jsonData = self.read_state_file(self.work_file, ("work",))
+            self.scheduled_work = jsonData["work"] if jsonData else []
+        return self.scheduled_work
+
+    def save_scheduled_work(self, work):
+        """
+        Replaces the scheduled hourly work, only writing it to disk when it changed.
+        """
+        if work != self.load_scheduled_work() or not os.path.isfile(self.work_file):
+            self.write_state_file(self.work_file, json.dumps({"work": work}))
+        self.scheduled_work = work
+
+    def load_hosts(self, counters):
+        """
+        Rebuilds the host tracking cache from the per-minute counters and the host metadata.
+        The metadata is kept in memory between executions and only read from disk after a restart.
+
+        Parameters:
+        counters(dict): ``[seen, hu]`` per host entity ID, as written by ``save_hosts``.
+
+        :return: dict with seen, hu, name, tags and mz per host entity ID
+        """
+        if self.host_metadata is None:
+            jsonData = self.read_state_file(self.host_metadata_file, ("hosts",))
+            self.host_metadata = {}
+            for host_id, metadata in (jsonData["hosts"] if jsonData else {}).items():
+                tags = {sys.intern(key): sys.intern(value) for key, value in metadata["tags"].items()}
+                self.host_metadata[host_id] = {"name": sys.intern(metadata["name"]), "tags": tags, "mz": intern_management_zones(metadata["mz"])}
+        hosts = {}
+        for host_id, counter in counters.items():
+            if isinstance(counter, dict): # Written by a version storing everything in one file
+                hosts[host_id] = counter
+                continue
+            metadata = self.host_metadata.get(host_id, {"name": "", "tags": {}, "mz": ()})
+            hosts[host_id] = {"seen": counter[0], "hu": counter[1], "name": metadata["name"], "tags": metadata["tags"], "mz": metadata["mz"]}
+        return hosts
+
+    def save_hosts(self, last_millis, hosts):
+        """
+        Stores the host tracking cache in two files: the seen and hu counters, rewritten every minute,
+        and the names, tags and management zones, only rewritten when one of them changed.
+        """
+        changed = False
+        for host_id, host in hosts.items():
+            metadata = self.host_metadata.get(host_id)
+            if metadata is None or metadata["name"] != host["name"] or metadata["tags"] != host["tags"] or metadata["mz"] != host["mz"]:
+                self.host_metadata[host_id] = {"name": host["name"], "tags": host["tags"], "mz": host["mz"]}
+                changed = True
+        if changed:
+            self.write_state_file(self.host_metadata_file, json.dumps({"hosts": self.host_metadata}))
+        counters = {host_id: [host["seen"], host["hu"]] for host_id, host in hosts.items()}
+        self.write_state_file(self.tempfile, json.dumps({"last_millis": last_millis, "hosts": counters}))
+
+    def prune_host_metadata(self, hosts):
+        """
+        Forgets the metadata and fingerprints of hosts not seen during the hour that just ended.
+        """
+        removed = [host_id for host_id in self.host_metadata if host_id not in hosts]
+        for host_id in removed:
+            del self.host_metadata[host_id]
+        for host_id in [host_id for host_id in self.host_fingerprints if host_id not in hosts]:
+            del self.host_fingerprints[host_id]
+        if removed:
+            self.write_state_file(self.host_metadata_file, json.dumps({"hosts": self.host_metadata}))
+
+    def load_entity_cache(self):
+        """
+        Reads the entity definitions stored by previous runs, skipping the ones older than the configured TTL.
+
+        :return: The entity definitions, keyed by entity ID
+        """
+        self.entity_cache_synced = {}
+        entity_definitions = {}
+        jsonData = self.read_state_file(self.entity_cache_file, ("entities",))
+        if jsonData:
+            for entity_id, definition in jsonData["entities"].items():
+                synced = definition["synced"]
+                if self.current_millis - synced < self.entity_cache_ttl:
+                    tags = {sys.intern(key): sys.intern(value) for key, value in definition["tags"].items()}
+                    entity_definitions[entity_id] = EntityDefinition(sys.intern(definition["name"]), tags, intern_management_zones(definition["mz"]))
+                    self.entity_cache_synced[entity_id] = synced
+        self.logger.info(f"Loaded {len(entity_definitions)} entities from the entity cache")
+        return entity_definitions
+
+    def save_entity_cache(self, entity_definitions):
+        """
+        Stores the entity definitions for the next runs. Definitions fetched during this run are stamped with the current time.
+        Hosts are left out as they are refreshed every minute in the host cache.
+        """
+        entities = {}
+        for entity_id, definition in entity_definitions.items():
+            if entity_id.split('-')[0] != "HOST":
+                entities[entity_id] = {"name": definition.name, "tags": definition.tags, "mz": definition.mz, "synced": self.entity_cache_synced.get(entity_id, self.current_millis)}
+        self.write_state_file(self.entity_cache_file, json.dumps({"entities": entities}))
+
+    def read_state_file(self, path, keys):
+        """
+        Reads a JSON state file written by ``write_state_file``, falling back to its previous generation if it is missing or damaged.
+
+        Parameters:
+        path(string): Path of the state file.
+        keys(tuple): Keys a valid state has to contain.
+
+        :return: The parsed state, or None if no generation could be read
+        """
+        for generation in (path, path + ".prev"):
+            if os.path.isfile(generation) and os.path.getsize(generation):
+                data = ""
+                try:
+                    with open(generation, mode='r', encoding="utf-8") as f:
+                        data = f.read()
+                    jsonData = json.loads(data)
+                    if all(key in jsonData for key in keys):
+                        if generation != path:
+                            self.logger.warning(f"Using previous generation of {path}")
+                        return jsonData
+                    self.logger.warning(f"{generation} is missing one of {keys}")
+                except Exception as e:
+                    self.logger.exception(e)
+                    self.logger.warning(data[:1000])
+        return None
+
+    def write_state_file(self, path, data):
+        """
+        Replaces a state file without ever leaving a truncated one behind.
+        The new content is written to a temporary file in one call and synced to disk, the current generation is kept as ``.prev``
+        and the temporary file is renamed into place.
+
+        Parameters:
+        path(string): Path of the state file.
+        data(string): Serialized state.
+        """
+        data = data.encode("utf-8")
+        temporary = path + ".tmp"
+        fd = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o600)
+        try:
+            written = 0
+            while written < len(data):
+                written += os.write(fd, data[written:])
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        if os.path.isfile(path):
+            os.replace(path, path + ".prev")
+        os.replace(temporary, path)
 
     def request(self, url):
-        result = requests.get(url, verify=False, headers = {"Content-Type": "application/json"})
-        if result.status_code == 429:
-            return self.request(url)
+        result = self.send("GET", url, headers = {"Content-Type": "application/json"})
         if result.status_code > 300:
             raise RuntimeError(result.text)
         return result
 
+    def send(self, method, url, retries=MAX_RETRIES, deadline=None, **kwargs):
+        """
+        Sends an API call through the shared session, retrying throttled and temporarily failing calls.
+        Waits as long as the tenant asks for with Retry-After or X-RateLimit-Reset, with jittered exponential backoff otherwise.
+
+        Parameters:
+        retries(int): Retries of a throttled or failed call.
+        deadline(float): Time, in seconds since the epoch, the call has to finish by, the execution's deadline if None or later.
+
+        :return: The last response, which can still be an error if all retries failed
+        :raises RequestBudgetExceeded: if the execution used up its API calls or time
+        """
+        deadline = self.request_deadline if deadline is None else min(deadline, self.request_deadline)
+        attempt = 0
+        while True:
+            with self.request_stats_lock:
+                if self.request_stats["requests"] >= self.request_budget:
+                    raise RequestBudgetExceeded(f"Used all {self.request_budget} API calls of this execution")
+                self.request_stats["requests"] += 1
+            if time.time() > deadline:
+                raise RequestBudgetExceeded(f"Used all {self.request_time_budget} seconds of this execution")
+            # A call never outlives the execution, waiting for a pooled connection included
+            timeout = DeadlineTimeout(deadline, connect=HTTP_CONNECT_TIMEOUT, read=HTTP_READ_TIMEOUT)
+            try:
+                result = self.session.request(method, url, timeout=timeout, **kwargs)
+                self.count(bytes=len(kwargs.get("data") or b"") + len(result.content))
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, urllib3.exceptions.EmptyPoolError):
+                if attempt >= retries:
+                    raise
+                result = None
+            if result is not None and (result.status_code not in RETRY_STATUS_CODES or attempt >= retries):
+                return result
+            wait = self.get_retry_wait(result, attempt)
+            if time.time() + wait > deadline:
+                raise RequestBudgetExceeded(f"Waiting {wait:.1f}s to retry would exceed the {self.request_time_budget} seconds of this execution")
+            with self.request_stats_lock:
+                self.request_stats["retries"] += 1
+                if result is not None and result.status_code == 429:
+                    self.request_stats["throttled"] += 1
+            logger.info(f"Retrying {method} in {wait:.1f}s after " + (f"status {result.status_code}" if result is not None else "connection error or timeout"))
+            time.sleep(wait)
+            attempt += 1
+
+    def get_retry_wait(self, result, attempt):
+        """
+        Returns how many seconds to wait before retrying, preferring the time the tenant asked for.
+        """
+        backoff = random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF * 2 ** attempt))
+        if result is None:
+            return backoff
+        retry_after = result.headers.get("Retry-After")
+        if retry_after:
+            try:
+                return max(float(retry_after), 0) + random.uniform(0, RETRY_BACKOFF)
+            except ValueError:
+                try:
+                    return max(email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time(), 0) + random.uniform(0, RETRY_BACKOFF)
+                except (TypeError, ValueError):
+                    pass
+        rate_limit_reset = result.headers.get("X-RateLimit-Reset")
+        if rate_limit_reset:
+            try:
+                reset = float(rate_limit_reset)
+                # Dynatrace sends microseconds since the epoch, accept milliseconds and seconds as well
+                while reset > 1e11:
+                    reset /= 1000
+                return max(reset - time.time(), 0) + random.uniform(0, RETRY_BACKOFF)
+            except ValueError:
+                pass
+        return backoff
+
+    def query_metric(self, metric_selector, from_millis, to_millis):
+        """
+        Queries the Metrics API v2 for ``metric_selector`` between ``from_millis`` and ``to_millis``.
+
+        :return: The parsed Metrics API v2 result
+        """
+        return self.request(f'{self.tenant_id}/{METRIC_ENDPOINT}?Api-Token={self.token}&metricSelector={metric_selector}&from={from_millis}&to={to_millis}').json()
+
+    def get_entity_pages(self, url):
+        """
+        Yields the entities of an Entities API v2 listing one page at a time, following ``nextPageKey``.
+        A background thread requests the next pages as soon as their ``nextPageKey`` is known, while the caller processes the current one.
+        At most ``page_prefetch`` pages wait to be processed, so memory stays bounded by a few pages.
+
+        Parameters:
+        url(string): URL of the first page.
+        """
+        if self.page_prefetch < 1:
+            yield from self.fetch_entity_pages(url)
+            return
+        pages = queue.Queue(maxsize=self.page_prefetch)
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def prefetch():
+            try:
+                for entity_list in self.fetch_entity_pages(url):
+                    if not put(entity_list):
+                        return
+                put(done)
+            except Exception as e:
+                put(e)
+
+        threading.Thread(target=prefetch, daemon=True).start()
+        try:
+            while True:
+                entity_list = pages.get()
+                if entity_list is done:
+                    return
+                if isinstance(entity_list, Exception):
+                    raise entity_list
+                yield entity_list
+        finally:
+            # Lets the prefetch thread exit if the caller stops iterating early
+            stop.set()
+
+    def fetch_entity_pages(self, url):
+        """
+        Yields the entities of an Entities API v2 listing one page at a time, requesting each page after the previous one was consumed.
+        """
+        entity_api_response = self.request(url).json()
+        self.count(pages=1, entities=len(entity_api_response.get('entities', [])))
+        yield entity_api_response.get('entities', [])
+        next_page_key = entity_api_response.get('nextPageKey')
+        while next_page_key:
+            next_page_key = urllib.parse.quote(next_page_key)
+            entity_api_response = self.request(f'{self.tenant_id}/{ENTITY_ENDPOINT}?Api-Token={self.token}&nextPageKey={next_page_key}').json()
+            self.count(pages=1, entities=len(entity_api_response.get('entities', [])))
+            yield entity_api_response.get('entities', [])
+            next_page_key = entity_api_response.get('nextPageKey')
+
     def get_consumption_for_host_units(self, hosts):
-        nextPageKey = ""
-        api_host_response = self.request(f'{self.tenant_id}/{ENTITY_ENDPOINT}?from=now-6m&to=now-5m&pageSize=1000&entitySelector=type("HOST")&fields=+properties.memoryTotal,+properties.paasMemoryLimit,+properties.monitoringMode,+tags,+managementZones&Api-Token={self.token}')
-        api_response = api_host_response.json()
-        logger.info(f'Found {len(api_response["entities"])} hosts')
-        host_list = api_response["entities"]
+        number_of_hosts = 0
         # Use next-page-key to navigate results for big environments
-        if "nextPageKey" in api_response:
-            nextPageKey = api_response["nextPageKey"]
-        while nextPageKey != "":
-            api_host_next_response = self.request(f'{self.tenant_id}/{ENTITY_ENDPOINT}?Api-Token={self.token}&nextPageKey={nextPageKey}')
-            api_next_response = api_host_next_response.json()
-            if "nextPageKey" in api_next_response:
-                nextPageKey = api_next_response["nextPageKey"]
-            else:
-                nextPageKey = ""
-            logger.info(f'Found another {len(api_next_response["entities"])} hosts')
-            host_list = host_list + api_next_response["entities"]
-        logger.info(f'Found a total of {len(host_list)} hosts')
+        for host_list in self.get_entity_pages(f'{self.tenant_id}/{ENTITY_ENDPOINT}?from=now-6m&to=now-5m&pageSize=1000&entitySelector=type("HOST")&fields=+properties.memoryTotal,+properties.paasMemoryLimit,+properties.monitoringMode,+tags,+managementZones&Api-Token={self.token}'):
+            logger.info(f'Found {len(host_list)} hosts' if number_of_hosts == 0 else f'Found another {len(host_list)} hosts')
+            number_of_hosts += len(host_list)
+            self.add_host_units(hosts, host_list)
+        logger.info(f'Found a total of {number_of_hosts} hosts')
+
+    def add_host_units(self, hosts, host_list):
+        """
+        Counts one more minute of host units for every host of ``host_list`` that consumes any.
+
+        Parameters:
+        hosts(dict): Host tracking cache, keyed by host entity ID.
+        host_list(list): One page of HOST entities from the Entities API v2.
+        """
+        changed_hosts = []
         for host in host_list:
-            # If the host has been seen last minute, we count it towards host unit hours
+            # Tags, management zones and memory rarely change between two minutes, skip normalizing hosts that look the same as last time
+            fingerprint = hash((repr(host.get("properties")), repr(host.get('tags')), repr(host.get('managementZones')), host.get('displayName')))
+            known = self.host_fingerprints.get(host.get('entityId'))
+            if known and known[0] == fingerprint:
+                consumption = known[1]
+                if consumption <= 0:
+                    continue
+                if host.get('entityId') in hosts:
+                    hosts[host.get('entityId')]["seen"] += 1
+                    continue
+                if host.get('entityId') in self.host_metadata:
+                    metadata = self.host_metadata[host.get('entityId')]
+                    hosts[host.get('entityId')] = {"seen": 1, "hu": consumption, "name": metadata["name"], "tags": metadata["tags"], "mz": metadata["mz"]}
+                    continue
+            changed_hosts.append((host, fingerprint))
+        memories = []
+        monitoring_modes = []
+        for host, fingerprint in changed_hosts:
             memoryTotal = host.get("properties", {}).get("memoryTotal", 0)
             if "paasMemoryLimit" in host.get("properties", {}):
                 memoryTotal = host["properties"]["paasMemoryLimit"] * 1024 * 1024 # MB to B
-            consumption = self.calculate_host_units(memoryTotal, host.get("properties", {}).get("monitoringMode", "FULL_STACK"))
+            memories.append(memoryTotal)
+            monitoring_modes.append(host.get("properties", {}).get("monitoringMode", "FULL_STACK"))
+        for (host, fingerprint), consumption in zip(changed_hosts, self.calculate_host_units_batch(memories, monitoring_modes)):
+            # Hosts in a monitoring mode without host unit table do not consume any
+            consumption = consumption or 0
+            # If the host has been seen last minute, we count it towards host unit hours
             if consumption > 0:
                 if host.get('entityId') not in hosts:
                     hosts[host.get('entityId')] = {}
                     hosts[host.get('entityId')]["seen"] = 0
                     hosts[host.get('entityId')]["tags"] = {}
-                    hosts[host.get('entityId')]["mz"] = []
+                    hosts[host.get('entityId')]["mz"] = ()
                 hosts[host.get('entityId')]["seen"] += 1
                 hosts[host.get('entityId')]["hu"] = consumption
-                hosts[host.get('entityId')]["mz"] = host.get('managementZones', [])
-                hosts[host.get('entityId')]["name"] = host.get('displayName', "")
+                hosts[host.get('entityId')]["mz"] = intern_management_zones(host.get('managementZones', []))
+                hosts[host.get('entityId')]["name"] = sys.intern(host.get('displayName', ""))
                 hosts[host.get('entityId')]["tags"] = {}
                 for tag in host.get('tags'):
                     if "value" in tag:
-                        tagKey = re.sub("[^0-9a-z_-]", "", tag["key"].replace(" ", "").lower().replace("\'", "").replace("\"", "")[:100])
+                        tagKey = normalize_tag_key(tag["key"], strip_quotes=True)
                         if not tagKey.isdigit():
                             if tagKey in hosts[host.get('entityId')]["tags"] or len(hosts[host.get('entityId')]["tags"]) < 50:
-                                hosts[host.get('entityId')]["tags"][tagKey] = tag["value"][:250].replace("\"", "\\\"").replace("'", "\\'")
-                                
+                                hosts[host.get('entityId')]["tags"][tagKey] = escape_tag_value(tag["value"])
+            self.host_fingerprints[host.get('entityId')] = (fingerprint, consumption)
+
     # Numbers smaller than 1 cannot be different from these
     min_host_units = {
         "FULL_STACK": {1.6: 0.1, 4: 0.25, 8: 0.5, 16: 1.0},
         "INFRA_ONLY": {1.6: 0.03, 4: 0.075, 8: 0.15, 16: 0.3, 32: 0.6, 48: 0.9, 64: 1}
 }
+    # Sorted memory breakpoints in GiB and the host units below each of them, looked up with bisect
+    host_unit_breakpoints = {mode: (list(table), list(table.values())) for mode, table in min_host_units.items()}
+
     def calculate_host_units(self, memory: float, monitoring_mode="FULL_STACK") -> float:
         """
         Calculates the host units number from the memory in bytes
@@ -171,138 +1082,298 @@ class LicensePluginRemote(RemoteBasePlugin):
         :param monitoring_mode: FULL_STACK or INFRA_ONLY
         :return: The number of host units for this amount of memory
         """
-        if memory <= 0:
-            return 0
-            
-        if monitoring_mode == "INFRASTRUCTURE":
-            monitoring_mode = "INFRA_ONLY"
+        return self.calculate_host_units_batch([memory], [monitoring_mode])[0]
+
+    def calculate_host_units_batch(self, memories, monitoring_modes):
+        """
+        Calculates the host units of many hosts in one pass, see ``calculate_host_units``.
+        Below 16 GiB, monitoring modes without a table return None.
+        :param memories: Memory of each host in bytes
+        :param monitoring_modes: Monitoring mode of each host, FULL_STACK or INFRA_ONLY
+        :return: The number of host units of each host, in the same order
+        """
+        host_units = []
+        for memory, monitoring_mode in zip(memories, monitoring_modes):
+            if memory <= 0:
+                host_units.append(0)
+                continue
 
-        mem_gigs = memory / (1024 ** 3)
+            if monitoring_mode == "INFRASTRUCTURE":
+                monitoring_mode = "INFRA_ONLY"
 
-        if mem_gigs >= 16:
-            if monitoring_mode == "FULL_STACK":
-                return ceil(mem_gigs / 16)
-            return min(ceil(mem_gigs / 16) * 0.3, 1.0)
-        else:
-            for mem, hu in self.min_host_units[monitoring_mode].items():
-                if mem_gigs < mem:
-                    return hu
-
-
-    def push_consumption_for_host_units(self, hosts):
-        payload = ''
-        number_of_lines = 0
-        for host in hosts:
-            consumption = hosts[host].get('hu', 0)
-            tags = ""
-            for (key,val) in hosts[host]["tags"].items():
-                if len(tags) < 1500:
-                    tags += f',{key}="' + val + '"'
-            number_of_lines += 1
-            payload += f'consumption.hostUnit,dt.entity.host={host}{tags} {consumption}\n'
-            if hosts[host]["seen"] > 4: # Host Unit Hours are only counted if a host is seen 5 or more times in one hour
-                number_of_lines += 1
-                payload = payload + f'consumption.hostUnitHours,dt.entity.host={host}{tags} {consumption}\n'
+            mem_gigs = memory / (1024 ** 3)
+
+            if mem_gigs >= 16:
+                if monitoring_mode == "FULL_STACK":
+                    host_units.append(ceil(mem_gigs / 16))
+                else:
+                    host_units.append(min(ceil(mem_gigs / 16) * 0.3, 1.0))
             else:
-                logger.info(f"Not reporting HU Hours for {host} due to only being seen " + str(hosts[host]["seen"]) + " time(s)")
-            if number_of_lines >= 998: # 2 lines can be added in one loop
-                r = requests.post(f'{self.tenant_id}/{METRIC_INGEST_ENDPOINT}?Api-Token={self.token}', data=payload.encode('utf-8'), verify=False, headers={"Content-Type": "text/plain"})
-                logger.info(f"Pushing HU via API returned: {r.text}")
-                number_of_lines = 0
-                payload = ''
-        if payload != "":
-            r = requests.post(f'{self.tenant_id}/{METRIC_INGEST_ENDPOINT}?Api-Token={self.token}', data=payload.encode('utf-8'), verify=False, headers={"Content-Type": "text/plain"})
-            logger.info(f"Pushing HU via API returned: {r.text}")
-
-    def calculate_and_push_consumption_for_dem(self, dem_entities_values):
+                breakpoints, units = self.host_unit_breakpoints.get(monitoring_mode, ((), ()))
+                index = bisect_right(breakpoints, mem_gigs)
+                host_units.append(units[index] if index < len(units) else None)
+        return host_units
+
+    def push_consumption_for_host_units(self, hosts, backfilled_hour=None):
+        """
+        Pushes the HU and HU hours of the hour that just ended.
+
+        Parameters:
+        hosts(dict): Host tracking cache of the hour.
+        backfilled_hour(string): End of the hour if it is pushed later. The lines are then pushed to the backfilled metric keys with a backfilled_hour dimension.
+        """
+        backfilled = BACKFILLED_METRIC_SUFFIX if backfilled_hour else ""
+        hour = f',backfilled_hour="{backfilled_hour}"' if backfilled_hour else ""
+        with self.ingest_batcher("HU") as batcher:
+            for host in hosts:
+                consumption = hosts[host].get('hu', 0)
+                tags = ""
+                dimensions = 2 if hour else 1
+                for (key,val) in hosts[host]["tags"].items():
+                    if len(tags) < 1500:
+                        tags += f',{key}="' + val + '"'
+                        dimensions += 1
+                batcher.add(f'consumption.hostUnit{backfilled},dt.entity.host={host}{hour}{tags} {consumption}', dimensions)
+                if hosts[host]["seen"] > 4: # Host Unit Hours are only counted if a host is seen 5 or more times in one hour
+                    batcher.add(f'consumption.hostUnitHours{backfilled},dt.entity.host={host}{hour}{tags} {consumption}', dimensions)
+                else:
+                    logger.info(f"Not reporting HU Hours for {host} due to only being seen " + str(hosts[host]["seen"]) + " time(s)")
+
+    def ingest_batcher(self, description):
+        """
+        Returns an IngestBatcher pushing its batches to the metric ingest API, logging a summary once all batches are sent.
+
+        Parameters:
+        description(string): Name of the metrics in the log messages.
+        """
+        return IngestBatcher(lambda payload: self.push_metric_lines(payload, description), workers=self.ingest_workers, done=lambda results: self.log_ingest_summary(results, description))
+
+    def push_metric_lines(self, payload, description):
+        """
+        Pushes one batch of metric lines to the metric ingest API.
+        The batch is written to the spool directory first and only removed once the API accepted it, so it is replayed by later executions if pushing fails.
+
+        :return: dict with the status code, the accepted and invalid line counts and the error reported by the API
+        """
+        spool_file = self.spool_batch(payload, description)
+        try:
+            result = self.post_metric_lines(payload, description)
+        except Exception as e:
+            # The batch stays in the spool and is replayed by a later execution, so the work that built it is done
+            # and must not be redone, or the batches of the same work already accepted would be pushed twice
+            return {"status": 0, "linesOk": 0, "linesInvalid": 0, "error": str(e)}
+        if self.is_batch_done(result):
+            os.remove(spool_file)
+        return result
+
+    def post_metric_lines(self, payload, description, retries=MAX_RETRIES, deadline=None):
+        """
+        Sends one batch of metric lines to the metric ingest API.
+        ``retries`` and ``deadline`` are passed on to ``send``.
+
+        :return: dict with the status code, the accepted and invalid line counts and the error reported by the API
+        """
+        data = payload.encode('utf-8')
+        headers = {"Content-Type": "text/plain"}
+        if self.ingest_compression_level > 0:
+            # Metric keys, dimension names and tags repeat on every line, so the batches compress very well
+            data = gzip.compress(data, compresslevel=min(self.ingest_compression_level, 9))
+            headers["Content-Encoding"] = "gzip"
+        r = self.send("POST", f'{self.tenant_id}/{METRIC_INGEST_ENDPOINT}?Api-Token={self.token}', data=data, headers=headers, retries=retries, deadline=deadline)
+        logger.info(f"Pushing {description} via API returned: {r.text}")
+        result = {"status": r.status_code, "linesOk": 0, "linesInvalid": 0, "error": None}
+        try:
+            response = r.json()
+            result["linesOk"] = response.get("linesOk") or 0
+            result["linesInvalid"] = response.get("linesInvalid") or 0
+            result["error"] = response.get("error")
+        except ValueError:
+            result["error"] = r.text
+        if r.status_code >= 300 and not result["error"]:
+            result["error"] = r.text
+        self.count(lines=result["linesOk"], invalid_lines=result["linesInvalid"], failures=1 if result["error"] else 0)
+        return result
+
+    def is_batch_done(self, result):
+        """
+        Tells whether a pushed batch can leave the spool: it was accepted, or rejected in a way sending it again cannot fix.
+        """
+        if 200 <= result["status"] < 300:
+            return True
+        if result["status"] in (400, 413):
+            logger.warning(f"Dropping ingest batch rejected with status {result['status']}: {result['error']}")
+            return True
+        return False
+
+    def spool_batch(self, payload, description):
+        """
+        Writes a batch to the spool directory, named after its creation time, an unique ID, the number of failed retries and its description.
+
+        :return: Path of the spool file
+        """
+        name = f'{int(time.time() * 1000)}-{uuid.uuid4().hex}-0-{description.replace(" ", "_")}.lp'
+        spool_file = os.path.join(self.spool_directory, name)
+        with open(spool_file + ".tmp", mode="w", encoding="utf-8") as f:
+            f.write(payload)
+        # Renamed only once complete, so a crash never leaves a truncated batch behind
+        os.replace(spool_file + ".tmp", spool_file)
+        return spool_file
+
+    def replay_spooled_batches(self):
+        """
+        Pushes the batches left in the spool directory by failed pushes, oldest first, for up to ``SPOOL_REPLAY_TIME_BUDGET`` seconds.
+        A batch is retried with exponential backoff and dropped once it is older than the maximum age or the spool grows beyond its maximum size.
+        The spool backs off between executions, so a batch is posted once per execution without retries.
+        """
+        deadline = time.time() + SPOOL_REPLAY_TIME_BUDGET
+        spooled = []
+        for name in os.listdir(self.spool_directory):
+            if name.endswith(".lp"):
+                path = os.path.join(self.spool_directory, name)
+                try:
+                    created, batch_id, attempts, description = name[:-len(".lp")].split("-", 3)
+                    spooled.append((int(created), batch_id, int(attempts), description.replace("_", " "), path, os.path.getsize(path), os.path.getmtime(path)))
+                except ValueError:
+                    logger.warning(f"Ignoring {path}, it is not named like a spooled ingest batch")
+            elif name.endswith(".tmp"):
+                os.remove(os.path.join(self.spool_directory, name))
+        if not spooled:
+            return
+        spooled.sort()
+        now = int(time.time() * 1000)
+        spool_size = sum(batch[5] for batch in spooled)
+        replayed = 0
+        for created, batch_id, attempts, description, path, size, last_attempt in spooled:
+            if now - created > self.spool_max_age or spool_size > self.spool_max_size:
+                logger.warning(f"Dropping unsent {description} ingest batch from {created} after {attempts} retries")
+                os.remove(path)
+                spool_size -= size
+                continue
+            # A batch not retried yet waits as long after it was spooled as after its first retry
+            if time.time() - last_attempt < min(SPOOL_RETRY_BACKOFF * 2 ** max(attempts - 1, 0), SPOOL_RETRY_BACKOFF_MAX):
+                continue
+            if time.time() > deadline:
+                logger.info(f"Stopped replaying unsent ingest batches after {SPOOL_REPLAY_TIME_BUDGET} seconds")
+                break
+            with open(path, mode="r", encoding="utf-8") as f:
+                payload = f.read()
+            try:
+                result = self.post_metric_lines(payload, description, retries=0, deadline=deadline)
+            except RequestBudgetExceeded:
+                raise
+            except Exception as e:
+                result = {"status": 0, "error": str(e)}
+            if self.is_batch_done(result):
+                os.remove(path)
+                spool_size -= size
+                replayed += 1
+            else:
+                # The new name counts the failed retry, its modification time is when it was last tried
+                retry_path = os.path.join(self.spool_directory, f'{created}-{batch_id}-{attempts + 1}-{description.replace(" ", "_")}.lp')
+                os.replace(path, retry_path)
+                os.utime(retry_path)
+        logger.info(f"Replayed {replayed} of {len(spooled)} unsent ingest batches")
+
+    def log_ingest_summary(self, results, description):
+        """
+        Logs the outcome of all batches pushed for ``description``, failed batches in the order they were built.
+        """
+        if not results:
+            return
+        lines_ok = sum(result["linesOk"] for result in results if result)
+        lines_invalid = sum(result["linesInvalid"] for result in results if result)
+        failed = 0
+        for batch, result in enumerate(results, 1):
+            if result is None or result["error"]:
+                failed += 1
+                logger.warning(f"Pushing {description} batch {batch}/{len(results)} failed: " + (str(result["error"]) if result else "request not sent"))
+        logger.info(f"Pushed {description} in {len(results)} batches: {lines_ok} lines accepted, {lines_invalid} lines invalid, {failed} batches failed")
+
+    def calculate_and_push_consumption_for_dem(self, dem_entities_values, last_millis, current_millis, backfilled_hour=None):
         """
         Calculates DEM consumption for the tenant by using different Dynatrace provided metrics.
 
         Parameters:
         dem_entities_values(dict): Dictionary containing information about each entity in Dynatrace to link consumption to applications.
+        last_millis(int): Start of the hour to calculate.
+        current_millis(int): End of the hour to calculate.
+        backfilled_hour(string): End of the hour a backfill pushes. The lines are then pushed to the backfilled metric keys with a backfilled_hour dimension.
         """
-        self.add_entities(dem_entities_values, 'APPLICATION')
-        self.add_entities(dem_entities_values, 'CUSTOM_APPLICATION')
-        self.add_entities(dem_entities_values, 'MOBILE_APPLICATION')
-        self.add_entities(dem_entities_values, 'HTTP_CHECK')
-        self.add_entities(dem_entities_values, 'SYNTHETIC_TEST')
-
-        web_app_without_replay = self.request(f'{self.tenant_id}/{METRIC_ENDPOINT}?Api-Token={self.token}&metricSelector=builtin:billing.apps.web.sessionsWithoutReplayByApplication&from={self.last_millis-60*60*1000}&to={self.current_millis-60*60*1000}').json()
-        web_app_with_replay = self.request(f'{self.tenant_id}/{METRIC_ENDPOINT}?Api-Token={self.token}&metricSelector=builtin:billing.apps.web.sessionsWithReplayByApplication&from={self.last_millis-60*60*1000}&to={self.current_millis-60*60*1000}').json()
-        web_app_properties = self.request(f'{self.tenant_id}/{METRIC_ENDPOINT}?Api-Token={self.token}&metricSelector=builtin:billing.apps.web.userActionPropertiesByApplication&from={self.last_millis-60*60*1000}&to={self.current_millis-60*60*1000}').json()
-        custom_app_sessions = self.request(f'{self.tenant_id}/{METRIC_ENDPOINT}?Api-Token={self.token}&metricSelector=builtin:billing.apps.custom.sessionsWithoutReplayByApplication&from={self.last_millis-60*60*1000}&to={self.current_millis-60*60*1000}').json()
-        custom_app_properties = self.request(f'{self.tenant_id}/{METRIC_ENDPOINT}?Api-Token={self.token}&metricSelector=builtin:billing.apps.custom.userActionPropertiesByDeviceApplication&from={self.last_millis-60*60*1000}&to={self.current_millis-60*60*1000}').json()
-        mobile_app_without_replay = self.request(f'{self.tenant_id}/{METRIC_ENDPOINT}?Api-Token={self.token}&metricSelector=builtin:billing.apps.mobile.sessionsWithoutReplayByApplication&from={self.last_millis-60*60*1000}&to={self.current_millis-60*60*1000}').json()
-        mobile_app_properties = self.request(f'{self.tenant_id}/{METRIC_ENDPOINT}?Api-Token={self.token}&metricSelector=builtin:billing.apps.mobile.userActionPropertiesByMobileApplication&from={self.last_millis-60*60*1000}&to={self.current_millis-60*60*1000}').json()
-        mobile_app_with_replay = self.request(f'{self.tenant_id}/{METRIC_ENDPOINT}?Api-Token={self.token}&metricSelector=builtin:billing.apps.mobile.sessionsWithReplayByApplication&from={self.last_millis-60*60*1000}&to={self.current_millis-60*60*1000}').json()
-        synthetic_actions = self.request(f'{self.tenant_id}/{METRIC_ENDPOINT}?Api-Token={self.token}&metricSelector=builtin:billing.synthetic.actions&from={self.last_millis-60*60*1000}&to={self.current_millis-60*60*1000}').json()
-        synthetic_requests = self.request(f'{self.tenant_id}/{METRIC_ENDPOINT}?Api-Token={self.token}&metricSelector=builtin:billing.synthetic.requests&from={self.last_millis-60*60*1000}&to={self.current_millis-60*60*1000}').json()
-        synthetic_external = self.request(f'{self.tenant_id}/{METRIC_ENDPOINT}?Api-Token={self.token}&metricSelector=builtin:billing.synthetic.external&from={self.last_millis-60*60*1000}&to={self.current_millis-60*60*1000}').json()
+        backfilled = BACKFILLED_METRIC_SUFFIX if backfilled_hour else ""
+        hour = f',backfilled_hour="{backfilled_hour}"' if backfilled_hour else ""
+        pulled_metrics = self.query_dem_metrics(dem_entities_values, last_millis - 60 * 60 * 1000, current_millis - 60 * 60 * 1000)
 
         dem_consumption = {}
         dem_synthetic_consumption = {}
-        self.add_consumption(dem_consumption, dem_entities_values, web_app_without_replay, 0.25)
-        self.add_consumption(dem_consumption, dem_entities_values, web_app_with_replay, 1)
-        self.add_consumption(dem_consumption, dem_entities_values, web_app_properties, 0.01)
-        self.add_consumption(dem_consumption, dem_entities_values, custom_app_sessions, 0.25)
-        self.add_consumption(dem_consumption, dem_entities_values, custom_app_properties, 0.01)
-        self.add_consumption(dem_consumption, dem_entities_values, mobile_app_without_replay, 0.25)
-        self.add_consumption(dem_consumption, dem_entities_values, mobile_app_properties, 0.01)
-        self.add_consumption(dem_consumption, dem_entities_values, mobile_app_with_replay, 1)
-        self.add_consumption(dem_synthetic_consumption, dem_entities_values, synthetic_actions, 1)
-        self.add_consumption(dem_synthetic_consumption, dem_entities_values, synthetic_requests, 0.1)
-        self.add_consumption(dem_synthetic_consumption, dem_entities_values, synthetic_external, 0.1)
-            
-        payload = ""
-        number_of_lines = 0
-        for app_id, consumption in dem_consumption.items():
-            app = app_id
-            tags = ""
-            if app_id in dem_entities_values:
-                app = dem_entities_values[app_id]["name"]
-                for (key,val) in dem_entities_values[app_id]["tags"].items():
-                    if len(tags) < 1500:
-                        tags += f',{key}="{val}"'
-            number_of_lines += 1
-            if payload != "":
-                payload += "\n"
-            payload += f'consumption.DEM.RUM,application="{app}"{tags} {consumption}'
-            if number_of_lines == 1000:
-                r = requests.post(f'{self.tenant_id}/{METRIC_INGEST_ENDPOINT}?Api-Token={self.token}', data=payload.encode('utf-8'), verify=False, headers={"Content-Type": "text/plain"})
-                logger.info(f"Pushing DEM RUM via API returned: {r.text}")
-                number_of_lines = 0
-                payload = ''
-        if payload != "":
-            r = requests.post(f'{self.tenant_id}/{METRIC_INGEST_ENDPOINT}?Api-Token={self.token}', data=payload.encode('utf-8'), verify=False, headers={"Content-Type": "text/plain"})
-            logger.info(f"Pushing DEM RUM via API returned: {r.text}")
-        else:
+        for metric, multiplier in DEM_RUM_METRICS.items():
+            self.add_consumption(dem_consumption, dem_entities_values, pulled_metrics.get(metric, {}), multiplier)
+        for metric, multiplier in DEM_SYNTHETIC_METRICS.items():
+            self.add_consumption(dem_synthetic_consumption, dem_entities_values, pulled_metrics.get(metric, {}), multiplier)
+
+        with self.ingest_batcher("DEM RUM") as batcher:
+            for app_id, consumption in dem_consumption.items():
+                app = app_id
+                tags = ""
+                dimensions = 2 if hour else 1
+                if app_id in dem_entities_values:
+                    app = dem_entities_values[app_id].name
+                    for (key,val) in dem_entities_values[app_id].tags.items():
+                        if len(tags) < 1500:
+                            tags += f',{key}="{val}"'
+                            dimensions += 1
+                batcher.add(f'consumption.DEM.RUM{backfilled},application="{app}"{hour}{tags} {consumption}', dimensions)
+        if batcher.total_lines == 0:
             logger.info(f"No DEM RUM to push")
             
-        payload = ""
-        number_of_lines = 0
-        for app_id, consumption in dem_synthetic_consumption.items():
-            app = app_id
-            tags = ""
-            if app_id in dem_entities_values:
-                app = dem_entities_values[app_id]["name"]
-                for (key,val) in dem_entities_values[app_id]["tags"].items():
-                    if len(tags) < 1500:
-                        tags += f',{key}="{val}"'
-            number_of_lines += 1
-            if payload != "":
-                payload += "\n"
-            payload += f'consumption.DEM.Synthetic,test="{app}"{tags} {consumption}'
-            if number_of_lines == 1000:
-                r = requests.post(f'{self.tenant_id}/{METRIC_INGEST_ENDPOINT}?Api-Token={self.token}', data=payload.encode('utf-8'), verify=False, headers={"Content-Type": "text/plain"})
-                logger.info(f"Pushing DEM Synthetic via API returned: {r.text}")
-                number_of_lines = 0
-                payload = ''
-        if payload != "":
-            r = requests.post(f'{self.tenant_id}/{METRIC_INGEST_ENDPOINT}?Api-Token={self.token}', data=payload.encode('utf-8'), verify=False, headers={"Content-Type": "text/plain"})
-            logger.info(f"Pushing DEM Synthetic via API returned: {r.text}")
-        else:
+        with self.ingest_batcher("DEM Synthetic") as batcher:
+            for app_id, consumption in dem_synthetic_consumption.items():
+                app = app_id
+                tags = ""
+                dimensions = 2 if hour else 1
+                if app_id in dem_entities_values:
+                    app = dem_entities_values[app_id].name
+                    for (key,val) in dem_entities_values[app_id].tags.items():
+                        if len(tags) < 1500:
+                            tags += f',{key}="{val}"'
+                            dimensions += 1
+                batcher.add(f'consumption.DEM.Synthetic{backfilled},test="{app}"{hour}{tags} {consumption}', dimensions)
+        if batcher.total_lines == 0:
             logger.info(f"No DEM Synthetic to push")
 
+    def query_dem_metrics(self, dem_entities_values, from_millis, to_millis):
+        """
+        Queries the DEM billing metrics between ``from_millis`` and ``to_millis`` and adds the applications and synthetic tests they mention to ``dem_entities_values``.
+
+        :return: dict with the Metrics API v2 result of each DEM metric
+        """
+        metrics = list(DEM_RUM_METRICS) + list(DEM_SYNTHETIC_METRICS)
+        if self.dem_batch_queries:
+            selectors = [",".join(metrics[i:i + METRIC_SELECTORS_PER_QUERY]) for i in range(0, len(metrics), METRIC_SELECTORS_PER_QUERY)]
+        else:
+            selectors = metrics
+        pool = ThreadPool(processes = min(self.dem_query_workers, len(selectors)))
+        try:
+            responses = pool.map(lambda selector: self.query_metric(selector, from_millis, to_millis), selectors)
+        finally:
+            pool.close()
+        # Every series in a response carries its metricId, whether one or several selectors were queried
+        pulled_metrics = {}
+        for response in responses:
+            for data_result in response.get('result', []):
+                pulled_metrics[data_result.get('metricId')] = {'result': [data_result]}
+
+        # Applications and synthetic tests are looked up by ID, only the ones missing from the entity cache cost an API call
+        missing_entity_ids = set()
+        for pulled_metric in pulled_metrics.values():
+            for data_result in pulled_metric.get('result', []):
+                for metric_data in data_result.get('data', []):
+                    if 'Unbilled' not in metric_data.get('dimensions', []):
+                        app_id = [app for app in metric_data.get('dimensions', []) if app != 'Billed'][0]
+                        if app_id not in dem_entities_values:
+                            missing_entity_ids.add(app_id)
+        self.add_entities_by_id(dem_entities_values, missing_entity_ids)
+        return pulled_metrics
+
     def add_entities(self, entity_dictionary, entity_type):
         """
         Adds a list of entities of type ``entity_type`` to the ``entity_dictionary``.
@@ -311,158 +1382,90 @@ class LicensePluginRemote(RemoteBasePlugin):
         entity_dictionary(dict): Contains all entities in order to link consumption to applications.
         entity_type(string): Type of the entities to list.
         """
-        
-        if int(time.time() * 1000) - self.current_millis < 40000:
-            logger.info("Fetch " + entity_type)
-            # DYNAMO_DB_TABLE do not have a managementZones value, so we use the one of the AWS_AVAILABILITY_ZONE where they sit
-            if entity_type == 'DYNAMO_DB_TABLE':
-                entity_api_response = self.request(f'{self.tenant_id}/{ENTITY_ENDPOINT}?Api-Token={self.token}&pageSize=4000&entitySelector=type("{entity_type}")&from={self.last_millis-24*60*60*1000}&fields=toRelationships,tags').json()
-                entity_list = entity_api_response.get('entities', [])
+        if entity_type in self.fetched_entity_types:
+            return
+        logger.info("Fetch " + entity_type)
+        # Mark the type before fetching so the AWS relationship lookups below cannot recurse into it again
+        self.fetched_entity_types.add(entity_type)
+        # DYNAMO_DB_TABLE do not have a managementZones value, so we use the one of the AWS_AVAILABILITY_ZONE where they sit
+        if entity_type == 'DYNAMO_DB_TABLE':
+            for entity_list in self.get_entity_pages(f'{self.tenant_id}/{ENTITY_ENDPOINT}?Api-Token={self.token}&pageSize=4000&entitySelector=type("{entity_type}")&from={self.last_millis-24*60*60*1000}&fields=toRelationships,tags'):
                 for entity in entity_list:
                     aws_availability_zone = entity.get('toRelationships', {}).get('isSiteOf', [{}])[0].get('id')
-                    if aws_availability_zone:
-                        if aws_availability_zone not in entity_dictionary:
-                            self.add_entities(entity_dictionary, aws_availability_zone.split('-')[0])
-                        entity_dictionary[entity.get('entityId', '')] = {}
-                        entity_dictionary[entity.get('entityId', '')]["mz"] = entity_dictionary[aws_availability_zone]
-                        entity_dictionary[entity.get('entityId', '')]["tags"] = {}
-                        for tag in entity.get('tags', []):
-                            if "value" in tag:
-                                tagKey = re.sub("[^0-9a-z_-]", "", tag["key"].replace(" ", "").lower()[:100])
-                                if len(entity_dictionary[entity.get('entityId', '')]["tags"]) < 50:
-                                    entity_dictionary[entity.get('entityId', '')]["tags"][tagKey] = tag["value"][:250].replace("\"", "\\\"").replace("'", "\\\'")
-                        entity_dictionary[entity.get('entityId', '')]["name"] = entity.get('displayName', "")
-                    else:
-                        entity_dictionary[entity.get('entityId', '')] = {}
-                        entity_dictionary[entity.get('entityId', '')]["mz"] = [{}]
-                        entity_dictionary[entity.get('entityId', '')]["tags"] = {}
-                        for tag in entity.get('tags', []):
-                            if "value" in tag:
-                                tagKey = re.sub("[^0-9a-z_-]", "", tag["key"].replace(" ", "").lower()[:100])
-                                if len(entity_dictionary[entity.get('entityId', '')]["tags"]) < 50:
-                                    entity_dictionary[entity.get('entityId', '')]["tags"][tagKey] = tag["value"][:250].replace("\"", "\\\"").replace("'", "\\\'")
-                        entity_dictionary[entity.get('entityId', '')]["name"] = entity.get('displayName', "")
-                next_page_key = entity_api_response.get('nextPageKey')
-                while next_page_key:
-                    next_page_key = urllib.parse.quote(next_page_key)
-                    entity_api_response = self.request(f'{self.tenant_id}/{ENTITY_ENDPOINT}?Api-Token={self.token}&nextPageKey={next_page_key}').json()
-                    entity_list = entity_api_response.get('entities', [])
-                    for entity in entity_list:
-                        aws_availability_zone = entity.get('toRelationships', {}).get('isSiteOf', [{}])[0].get('id')
-                        if aws_availability_zone:
-                            if aws_availability_zone not in entity_dictionary:
-                                self.add_entities(entity_dictionary, aws_availability_zone.split('-')[0])
-                            entity_dictionary[entity.get('entityId', '')] = {}
-                            entity_dictionary[entity.get('entityId', '')]["mz"] = entity_dictionary[aws_availability_zone]
-                            entity_dictionary[entity.get('entityId', '')]["tags"] = {}
-                            for tag in entity.get('tags', []):
-                                if "value" in tag:
-                                    tagKey = re.sub("[^0-9a-z_-]", "", tag["key"].replace(" ", "").lower()[:100])
-                                    if len(entity_dictionary[entity.get('entityId', '')]["tags"]) < 50:
-                                        entity_dictionary[entity.get('entityId', '')]["tags"][tagKey] = tag["value"][:250].replace("\"", "\\\"").replace("'", "\\\'")
-                            entity_dictionary[entity.get('entityId', '')]["name"] = entity.get('displayName', "")
-                        else:
-                            entity_dictionary[entity.get('entityId', '')] = {}
-                            entity_dictionary[entity.get('entityId', '')]["mz"] = [{}]
-                            entity_dictionary[entity.get('entityId', '')]["tags"] = {}
-                            for tag in entity.get('tags', []):
-                                if "value" in tag:
-                                    tagKey = re.sub("[^0-9a-z_-]", "", tag["key"].replace(" ", "").lower()[:100])
-                                    if len(entity_dictionary[entity.get('entityId', '')]["tags"]) < 50:
-                                        entity_dictionary[entity.get('entityId', '')]["tags"][tagKey] = tag["value"][:250].replace("\"", "\\\"").replace("'", "\\\'")
-                            entity_dictionary[entity.get('entityId', '')]["name"] = entity.get('displayName', "")
-                    next_page_key = entity_api_response.get('nextPageKey')
-            # EBS_VOLUME do not have a managementZones value, so we use the one of the EC2_INSTANCE where they belong
-            elif entity_type == 'EBS_VOLUME':
-                entity_api_response = self.request(f'{self.tenant_id}/{ENTITY_ENDPOINT}?Api-Token={self.token}&pageSize=4000&entitySelector=type("{entity_type}")&from={self.last_millis-24*60*60*1000}&fields=fromRelationships,tags').json()
-                entity_list = entity_api_response.get('entities', [])
+                    entity_dictionary[entity.get('entityId', '')] = self.entity_definition(entity, self.related_management_zones(entity_dictionary, aws_availability_zone))
+        # EBS_VOLUME do not have a managementZones value, so we use the one of the EC2_INSTANCE where they belong
+        elif entity_type == 'EBS_VOLUME':
+            for entity_list in self.get_entity_pages(f'{self.tenant_id}/{ENTITY_ENDPOINT}?Api-Token={self.token}&pageSize=4000&entitySelector=type("{entity_type}")&from={self.last_millis-24*60*60*1000}&fields=fromRelationships,tags'):
                 for entity in entity_list:
                     ec2_instance_id = entity.get('fromRelationships', {}).get('isDiskOf', [{}])[0].get('id')
-                    if ec2_instance_id:
-                        if ec2_instance_id not in entity_dictionary:
-                            self.add_entities(entity_dictionary, ec2_instance_id.split('-')[0])
-                        entity_dictionary[entity.get('entityId', '')] = {}
-                        entity_dictionary[entity.get('entityId', '')]["mz"] = entity_dictionary[ec2_instance_id]
-                        entity_dictionary[entity.get('entityId', '')]["tags"] = {}
-                        for tag in entity.get('tags', []):
-                            if "value" in tag:
-                                tagKey = re.sub("[^0-9a-z_-]", "", tag["key"].replace(" ", "").lower()[:100])
-                                if len(entity_dictionary[entity.get('entityId', '')]["tags"]) < 50:
-                                    entity_dictionary[entity.get('entityId', '')]["tags"][tagKey] = tag["value"][:250].replace("\"", "\\\"").replace("'", "\\\'")
-                        entity_dictionary[entity.get('entityId', '')]["name"] = entity.get('displayName', "")
-                    else:
-                        entity_dictionary[entity.get('entityId', '')] = {}
-                        entity_dictionary[entity.get('entityId', '')]["mz"] = [{}]
-                        entity_dictionary[entity.get('entityId', '')]["tags"] = {}
-                        for tag in entity.get('tags', []):
-                            if "value" in tag:
-                                tagKey = re.sub("[^0-9a-z_-]", "", tag["key"].replace(" ", "").lower()[:100])
-                                if len(entity_dictionary[entity.get('entityId', '')]["tags"]) < 50:
-                                    entity_dictionary[entity.get('entityId', '')]["tags"][tagKey] = tag["value"][:250].replace("\"", "\\\"").replace("'", "\\\'")
-                        entity_dictionary[entity.get('entityId', '')]["name"] = entity.get('displayName', "")
-                next_page_key = entity_api_response.get('nextPageKey')
-                while next_page_key:
-                    next_page_key = urllib.parse.quote(next_page_key)
-                    entity_api_response = self.request(f'{self.tenant_id}/{ENTITY_ENDPOINT}?Api-Token={self.token}&nextPageKey={next_page_key}').json()
-                    entity_list = entity_api_response.get('entities', [])
-                    for entity in entity_list:
-                        ec2_instance_id = entity.get('fromRelationships', {}).get('isDiskOf', [{}])[0].get('id')
-                        if ec2_instance_id:
-                            if ec2_instance_id not in entity_dictionary:
-                                self.add_entities(entity_dictionary, ec2_instance_id.split('-')[0])
-                            entity_dictionary[entity.get('entityId', '')] = {}
-                            entity_dictionary[entity.get('entityId', '')]["mz"] = entity_dictionary[ec2_instance_id]
-                            entity_dictionary[entity.get('entityId', '')]["tags"] = {}
-                            for tag in entity.get('tags', []):
-                                if "value" in tag:
-                                    tagKey = re.sub("[^0-9a-z_-]", "", tag["key"].replace(" ", "").lower()[:100])
-                                    if len(entity_dictionary[entity.get('entityId', '')]["tags"]) < 50:
-                                        entity_dictionary[entity.get('entityId', '')]["tags"][tagKey] = tag["value"][:250].replace("\"", "\\\"").replace("'", "\\\'")
-                            entity_dictionary[entity.get('entityId', '')]["name"] = entity.get('displayName', "")
-                        else:
-                            entity_dictionary[entity.get('entityId', '')] = {}
-                            entity_dictionary[entity.get('entityId', '')]["mz"] = [{}]
-                            entity_dictionary[entity.get('entityId', '')]["tags"] = {}
-                            for tag in entity.get('tags', []):
-                                if "value" in tag:
-                                    tagKey = re.sub("[^0-9a-z_-]", "", tag["key"].replace(" ", "").lower()[:100])
-                                    if len(entity_dictionary[entity.get('entityId', '')]["tags"]) < 50:
-                                        entity_dictionary[entity.get('entityId', '')]["tags"][tagKey] = tag["value"][:250].replace("\"", "\\\"").replace("'", "\\\'")
-                            entity_dictionary[entity.get('entityId', '')]["name"] = entity.get('displayName', "")
-                    next_page_key = entity_api_response.get('nextPageKey')
-            # Generic for anything else
-            else:
-                entity_api_response = self.request(f'{self.tenant_id}/{ENTITY_ENDPOINT}?Api-Token={self.token}&pageSize=4000&entitySelector=type("{entity_type}")&from={self.last_millis-24*60*60*1000}&fields=managementZones,tags').json()
-                entity_list = entity_api_response.get('entities', [])
-                for entity in entity_list:
-                    entity_dictionary[entity.get('entityId', '')] = {}
-                    entity_dictionary[entity.get('entityId', '')]["mz"] = entity.get('managementZones', [])
-                    entity_dictionary[entity.get('entityId', '')]["tags"] = {}
-                    for tag in entity.get('tags', []):
-                        if "value" in tag:
-                            tagKey = re.sub("[^0-9a-z_-]", "", tag["key"].replace(" ", "").lower()[:100])
-                            if len(entity_dictionary[entity.get('entityId', '')]["tags"]) < 50:
-                                entity_dictionary[entity.get('entityId', '')]["tags"][tagKey] = tag["value"][:250].replace("\"", "\\\"").replace("'", "\\\'")
-                    entity_dictionary[entity.get('entityId', '')]["name"] = entity.get('displayName', "")
-                next_page_key = entity_api_response.get('nextPageKey')
-                while next_page_key:
-                    next_page_key = urllib.parse.quote(next_page_key)
-                    entity_api_response = self.request(f'{self.tenant_id}/{ENTITY_ENDPOINT}?Api-Token={self.token}&nextPageKey={next_page_key}').json()
-                    entity_list = entity_api_response.get('entities', [])
-                    for entity in entity_list:
-                        entity_dictionary[entity.get('entityId', '')] = {}
-                        entity_dictionary[entity.get('entityId', '')]["mz"] = entity.get('managementZones', [])
-                        entity_dictionary[entity.get('entityId', '')]["tags"] = {}
-                        for tag in entity.get('tags', []):
-                            if "value" in tag:
-                                tagKey = re.sub("[^0-9a-z_-]", "", tag["key"].replace(" ", "").lower()[:100])
-                                if len(entity_dictionary[entity.get('entityId', '')]["tags"]) < 50:
-                                    entity_dictionary[entity.get('entityId', '')]["tags"][tagKey] = tag["value"][:250].replace("\"", "\\\"").replace("'", "\\\'")
-                        entity_dictionary[entity.get('entityId', '')]["name"] = entity.get('displayName', "")
-                    next_page_key = entity_api_response.get('nextPageKey')
-            logger.info("Fetched " + entity_type)
+                    entity_dictionary[entity.get('entityId', '')] = self.entity_definition(entity, self.related_management_zones(entity_dictionary, ec2_instance_id))
+        # Generic for anything else
         else:
-            logger.info("No time to fetch " + entity_type)
+            for entity_list in self.get_entity_pages(f'{self.tenant_id}/{ENTITY_ENDPOINT}?Api-Token={self.token}&pageSize=4000&entitySelector=type("{entity_type}")&from={self.last_millis-24*60*60*1000}&fields=managementZones,tags'):
+                for entity in entity_list:
+                    entity_dictionary[entity.get('entityId', '')] = self.entity_definition(entity, entity.get('managementZones', []))
+        logger.info("Fetched " + entity_type)
+
+    def entity_definition(self, entity, management_zones):
+        """
+        Builds the EntityDefinition of an entity returned by the Entities API v2, keeping up to 50 of its tags.
+
+        Parameters:
+        entity(dict): Entity as returned by the API.
+        management_zones(list): Management zones to attribute the entity's consumption to.
+        """
+        tags = {}
+        for tag in entity.get('tags', []):
+            if "value" in tag:
+                tagKey = normalize_tag_key(tag["key"])
+                if len(tags) < 50:
+                    tags[tagKey] = escape_tag_value(tag["value"])
+        return EntityDefinition(sys.intern(entity.get('displayName', "")), tags, intern_management_zones(management_zones))
+
+    def related_management_zones(self, entity_dictionary, related_entity_id):
+        """
+        Returns the management zones of the entity ``related_entity_id``, fetching its type first if needed.
+        Entities without a related entity, or whose related entity cannot be found, get an ``Undefined`` management zone.
+        """
+        if not related_entity_id:
+            return [{}]
+        if related_entity_id not in entity_dictionary:
+            self.add_entities(entity_dictionary, related_entity_id.split('-')[0])
+        if related_entity_id not in entity_dictionary:
+            return [{}]
+        return entity_dictionary[related_entity_id].mz
+
+    def add_entities_by_id(self, entity_dictionary, entity_ids):
+        """
+        Adds the entities with the given IDs to the ``entity_dictionary``, looking them up in concurrent chunks of ``entityId(...)`` selectors.
+        IDs the API does not return are recorded in ``self.missing_entities``.
+
+        Parameters:
+        entity_dictionary(dict): Contains all entities in order to link consumption to applications.
+        entity_ids(set): IDs of the entities to look up.
+        """
+        if not entity_ids:
+            return
+        entity_ids = sorted(entity_ids)
+        chunks = [entity_ids[i:i + ENTITY_IDS_PER_LOOKUP] for i in range(0, len(entity_ids), ENTITY_IDS_PER_LOOKUP)]
+        logger.info(f"Looking up {len(entity_ids)} entities in {len(chunks)} requests")
+        pool = ThreadPool(processes = min(self.entity_lookup_workers, len(chunks)))
+        try:
+            entity_lists = pool.map(self.get_entities_by_id, chunks)
+        finally:
+            pool.close()
+        for entity_list in entity_lists:
+            for entity in entity_list:
+                entity_dictionary[entity.get('entityId', '')] = self.entity_definition(entity, entity.get('managementZones', []))
+        self.missing_entities.update(entity_id for entity_id in entity_ids if entity_id not in entity_dictionary)
+
+    def get_entities_by_id(self, entity_ids):
+        """
+        Returns the entities with the given IDs, following ``nextPageKey`` if the API splits them over several pages.
+        """
+        entity_selector = urllib.parse.quote("entityId(" + ",".join(f'"{entity_id}"' for entity_id in entity_ids) + ")")
+        url = f'{self.tenant_id}/{ENTITY_ENDPOINT}?Api-Token={self.token}&pageSize={len(entity_ids)}&entitySelector={entity_selector}&from={self.last_millis-24*60*60*1000}&fields=managementZones,tags'
+        return [entity for entity_list in self.fetch_entity_pages(url) for entity in entity_list]
 
     def add_consumption(self, dem_consumption, dem_entities_values, pulled_metrics, multiplier):
         """
@@ -483,51 +1486,68 @@ class LicensePluginRemote(RemoteBasePlugin):
                     if app_id in dem_entities_values:
                         dem_consumption[app_id] = consumption + dem_consumption.get(app_id, 0)
 
-    def calculate_and_push_consumption_for_ddu(self, entity_definitions, hosts):
+    def calculate_and_push_consumption_for_ddu(self, entity_definitions, hosts, last_millis, current_millis, backfilled_hour=None):
         """
         Calculates DDU consumption for the tenant by using the Dynatrace provided metric.
 
         Parameters:
         entity_definitions(dict): Dictionary containing information about each entity in Dynatrace to link consumption to applications.
+        hosts(dict): Name, tags and management zones of the known hosts.
+        last_millis(int): Start of the hour to calculate.
+        current_millis(int): End of the hour to calculate.
+        backfilled_hour(string): End of the hour a backfill pushes. The lines are then pushed to the backfilled metric keys with a backfilled_hour dimension.
         """
+        backfilled = BACKFILLED_METRIC_SUFFIX if backfilled_hour else ""
+        hour = f',backfilled_hour="{backfilled_hour}"' if backfilled_hour else ""
         ddu_consumption = {}
-        ddu_per_entity = self.request(f'{self.tenant_id}/{METRIC_ENDPOINT}?Api-Token={self.token}&metricSelector=builtin:billing.ddu.metrics.byEntity&from={self.last_millis-180000}&to={self.current_millis-180000}').json()
-
-        for ddu_data in ddu_per_entity.get('result', {})[0].get('data', []):
+        ddu_data_list = self.query_ddu_metric(entity_definitions, hosts, last_millis - 180000, current_millis - 180000)
+        for ddu_data in ddu_data_list:
             entity_id = ddu_data.get('dimensions', [])[0]
             if entity_id:
                 consumption = sum([value for value in ddu_data.get('values') if value])
                 ddu_consumption['all'] = consumption + ddu_consumption.get('all', 0)
-                if entity_id not in entity_definitions:
-                    if entity_id.split('-')[0] == "HOST":
-                        if entity_id in hosts:
-                            entity_definitions[entity_id] = {}
-                            entity_definitions[entity_id]["mz"] = hosts[entity_id]["mz"]
-                            entity_definitions[entity_id]["tags"] = hosts[entity_id]["tags"]
-                            entity_definitions[entity_id]["name"] = hosts[entity_id]["name"]
-                    else:
-                        self.add_entities(entity_definitions, entity_id.split('-')[0])
                 if entity_id in entity_definitions:
-                    mz_names = []
-                    for mz_item in entity_definitions.get(entity_id)["mz"]:
-                        if isinstance(mz_item, str):
-                            mz_name = mz_item
-                        else:
-                            mz_name = mz_item.get('name', 'Undefined')
-                        mz_names.append(mz_name.replace("\"", "\\\"").replace("'", "\\\'"))
-                    for mz in mz_names:
+                    for mz_name in entity_definitions.get(entity_id).mz:
+                        mz = mz_name.replace("\"", "\\\"").replace("'", "\\\'")
                         ddu_consumption[mz] = consumption + ddu_consumption.get(mz, 0)
-        payload = ""
-        for mz, ddu_cost in ddu_consumption.items():
-            if payload != "":
-                payload += "\n"
-            payload += f'consumption.DDU,management_zone="{mz}" {ddu_cost}'
-        if payload != "":
-            r = requests.post(f'{self.tenant_id}/{METRIC_INGEST_ENDPOINT}?Api-Token={self.token}', data=payload.encode('utf-8'), verify=False, headers={"Content-Type": "text/plain"})
-            logger.info(f"Pushing DDU via API returned: {r.text}")
-        else:
+        with self.ingest_batcher("DDU") as batcher:
+            for mz, ddu_cost in ddu_consumption.items():
+                batcher.add(f'consumption.DDU{backfilled},management_zone="{mz}"{hour} {ddu_cost}', 2 if hour else 1)
+        if batcher.total_lines == 0:
             logger.info(f"No DDUs to push")
 
+    def query_ddu_metric(self, entity_definitions, hosts, from_millis, to_millis):
+        """
+        Queries the DDU consumption per entity between ``from_millis`` and ``to_millis`` and adds the entities it mentions to ``entity_definitions``.
+        Entities that cannot be found are recorded in ``self.missing_entities``.
+
+        :return: The data of the Metrics API v2 result, one series per entity
+        """
+        ddu_per_entity = self.query_metric("builtin:billing.ddu.metrics.byEntity", from_millis, to_millis)
+        ddu_data_list = ddu_per_entity.get('result', {})[0].get('data', [])
+
+        # Only resolve the entities that consumed DDUs instead of listing every entity of their types
+        missing_entity_ids = set()
+        for ddu_data in ddu_data_list:
+            entity_id = ddu_data.get('dimensions', [])[0]
+            if entity_id and entity_id not in entity_definitions and entity_id not in self.missing_entities:
+                if entity_id.split('-')[0] not in ("HOST",) + RELATIONSHIP_ENTITY_TYPES:
+                    missing_entity_ids.add(entity_id)
+        self.add_entities_by_id(entity_definitions, missing_entity_ids)
+
+        for ddu_data in ddu_data_list:
+            entity_id = ddu_data.get('dimensions', [])[0]
+            if entity_id and entity_id not in entity_definitions and entity_id not in self.missing_entities:
+                if entity_id.split('-')[0] == "HOST":
+                    if entity_id in hosts:
+                        entity_definitions[entity_id] = EntityDefinition(hosts[entity_id]["name"], hosts[entity_id]["tags"], intern_management_zones(hosts[entity_id]["mz"]))
+                else:
+                    self.add_entities(entity_definitions, entity_id.split('-')[0])
+                # Unknown types and entities deleted since their type was fetched are not looked up again this run
+                if entity_id not in entity_definitions:
+                    self.missing_entities.add(entity_id)
+        return ddu_data_list
+
     def add_management_zone_rule(self):
         """
         For the DDU and DEM metrics to work, a new rule has to be added to every Management Zone so we can easily filter on dashboards.
@@ -535,9 +1555,10 @@ class LicensePluginRemote(RemoteBasePlugin):
         """
         management_zones = self.request(f'{self.tenant_id}/{MZ_ENDPOINT}?Api-Token={self.token}').json()
         pool = ThreadPool(processes = 5)
-        for mz in management_zones.get('values', []):
-            pool.apply_async(self.update_management_zone_rule, (mz))
-        pool.close()
+        try:
+            pool.map(self.update_management_zone_rule, management_zones.get('values', []))
+        finally:
+            pool.close()
 
     def update_management_zone_rule(self, mz):
         management_zone_details = self.request(f'{self.tenant_id}/{MZ_ENDPOINT}/{mz["id"]}?Api-Token={self.token}').json()
@@ -557,5 +1578,8 @@ class LicensePluginRemote(RemoteBasePlugin):
         ]
         if dimensional_rule[0] not in management_zone_details.get("dimensionalRules", []):
             management_zone_details["dimensionalRules"] = management_zone_details.get("dimensionalRules", []) + dimensional_rule
-            r = requests.put(f'{self.tenant_id}/{MZ_ENDPOINT}/{mz["id"]}?Api-Token={self.token}', data = json.dumps(management_zone_details).encode('utf-8'), verify=False, headers = {'Content-Type': 'application/json'})
-            logger.info("Pushing MZ configuration for MZ " + mz["name"])
+            r = self.send("PUT", f'{self.tenant_id}/{MZ_ENDPOINT}/{mz["id"]}?Api-Token={self.token}', data = json.dumps(management_zone_details).encode('utf-8'), headers = {'Content-Type': 'application/json'})
+            if r.status_code >= 300:
+                logger.warning(f"Pushing MZ configuration for MZ {mz['name']} failed with status {r.status_code}: {r.text}")
+            else:
+                logger.info("Pushing MZ configuration for MZ " + mz["name"])
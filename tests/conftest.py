@@ -0,0 +1,38 @@
+"""
+Fixtures running LicensePluginRemote off-line against a MockTenant, see bench/harness.py.
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "bench"))
+from benchmark import start_execution # noqa: E402
+from harness import PluginHarness, load_plugin # noqa: E402
+from mock_tenant import MockTenant, SyntheticTenant # noqa: E402
+
+@pytest.fixture(scope="session")
+def license_plugin():
+    return load_plugin()
+
+@pytest.fixture
+def tenant():
+    with MockTenant(SyntheticTenant(hosts=20, entities=20, applications=3, aws_entities=2, tags=2, management_zones=2)) as mock:
+        yield mock
+
+@pytest.fixture
+def harness(license_plugin, tenant):
+    # One ingest worker keeps the order of the pushed batches deterministic
+    with PluginHarness(tenant.url, config={"ingest_workers": 1}) as harness:
+        yield harness
+
+@pytest.fixture
+def plugin(harness):
+    """
+    The harness' plugin, set up as at the start of an execution, so its methods can be called one by one.
+    Retries are not waited for.
+    """
+    plugin = harness.plugin
+    start_execution(plugin)
+    plugin.get_retry_wait = lambda result, attempt: 0
+    return plugin
@@ -0,0 +1,103 @@
+"""
+Tests the backfill of missed hours: its hourly windows, its progress across executions and the backfilled metric keys it pushes to.
+"""
+import json
+
+import pytest
+
+HOUR = 60 * 60 * 1000
+
+def record_pushes(plugin, fail=None):
+    """
+    Replaces the DEM and DDU pushes, so a backfill runs without querying anything.
+
+    Parameters:
+    fail(set): ``(work, from_millis)`` pushes that raise.
+
+    :return: List the ``(work, from_millis, to_millis, backfilled_hour)`` of every push is appended to
+    """
+    pushed = []
+
+    def push(work, from_millis, to_millis, backfilled_hour):
+        if (work, from_millis) in (fail or set()):
+            raise RuntimeError(f"{work} failed")
+        pushed.append((work, from_millis, to_millis, backfilled_hour))
+
+    plugin.calculate_and_push_consumption_for_dem = lambda entities, from_millis, to_millis, backfilled_hour=None: push("DEM", from_millis, to_millis, backfilled_hour)
+    plugin.calculate_and_push_consumption_for_ddu = lambda entities, hosts, from_millis, to_millis, backfilled_hour=None: push("DDU", from_millis, to_millis, backfilled_hour)
+    return pushed
+
+def scheduled_backfill(plugin, from_millis, to_millis):
+    plugin.schedule_backfill(from_millis, to_millis)
+    [item] = plugin.scheduled_work
+    return item
+
+def read_work(plugin):
+    with open(plugin.work_file, encoding="utf-8") as f:
+        return json.load(f)["work"]
+
+def test_backfill_pushes_hour_by_hour(plugin):
+    now = plugin.current_millis
+    item = scheduled_backfill(plugin, now - 5 * HOUR, now - 5 * HOUR // 2)
+    pushed = record_pushes(plugin)
+    assert plugin.backfill({}, item)
+    windows = [(now - 5 * HOUR, now - 4 * HOUR), (now - 4 * HOUR, now - 3 * HOUR), (now - 3 * HOUR, now - 5 * HOUR // 2)]
+    assert pushed == [
+        (work, from_millis, to_millis, plugin.format_backfilled_hour(to_millis))
+        for from_millis, to_millis in windows for work in ("DEM", "DDU")
+    ]
+    assert read_work(plugin)[0]["from"] == now - 5 * HOUR // 2
+
+def test_incomplete_last_hour_waits(plugin):
+    # Up to the last hourly push, the 24 hour cap still extends the backfill every execution
+    now = plugin.current_millis
+    item = scheduled_backfill(plugin, plugin.last_millis - 5 * HOUR // 2, plugin.last_millis)
+    pushed = record_pushes(plugin)
+    assert not plugin.backfill({}, item)
+    assert [push[2] for push in pushed if push[0] == "DEM"] == [now - 5 * HOUR // 2, now - 3 * HOUR // 2]
+    assert read_work(plugin) == [{"work": "Backfill", "from": plugin.last_millis - HOUR // 2, "to": plugin.last_millis, "done": []}]
+
+def test_no_time_budget(plugin):
+    plugin.backfill_time_budget = 0
+    item = scheduled_backfill(plugin, plugin.current_millis - 5 * HOUR, plugin.current_millis - 3 * HOUR)
+    pushed = record_pushes(plugin)
+    assert not plugin.backfill({}, item)
+    assert pushed == []
+
+def test_failed_hour_resumes_after_its_last_push(plugin):
+    now = plugin.current_millis
+    item = scheduled_backfill(plugin, now - 5 * HOUR, now - 3 * HOUR)
+    record_pushes(plugin, fail={("DDU", now - 4 * HOUR)})
+    with pytest.raises(RuntimeError):
+        plugin.backfill({}, item)
+    assert read_work(plugin) == [{"work": "Backfill", "from": now - 4 * HOUR, "to": now - 3 * HOUR, "done": ["DEM"]}]
+    plugin.scheduled_work = None
+    [item] = plugin.load_scheduled_work()
+    pushed = record_pushes(plugin)
+    assert plugin.backfill({}, item)
+    assert pushed == [("DDU", now - 4 * HOUR, now - 3 * HOUR, plugin.format_backfilled_hour(now - 3 * HOUR))]
+
+def test_adjacent_backfills_are_merged(plugin):
+    now = plugin.current_millis
+    plugin.schedule_backfill(now - 30 * HOUR, now - 28 * HOUR)
+    plugin.schedule_backfill(now - 28 * HOUR, now - 27 * HOUR)
+    plugin.schedule_backfill(now - 27 * HOUR, now - 27 * HOUR)
+    assert read_work(plugin) == [{"work": "Backfill", "from": now - 30 * HOUR, "to": now - 27 * HOUR, "done": []}]
+    plugin.schedule_backfill(now - 26 * HOUR, now - 25 * HOUR)
+    assert [item["from"] for item in read_work(plugin)] == [now - 30 * HOUR, now - 26 * HOUR]
+
+def test_nothing_to_backfill_without_dem_and_ddu(plugin):
+    plugin.get_dem = plugin.get_ddu = False
+    plugin.schedule_backfill(plugin.current_millis - 30 * HOUR, plugin.current_millis - 28 * HOUR)
+    assert plugin.load_scheduled_work() == []
+
+def test_backfilled_lines_keep_their_hour(plugin, tenant):
+    now = plugin.current_millis
+    item = scheduled_backfill(plugin, now - 5 * HOUR, now - 4 * HOUR)
+    assert plugin.backfill(plugin.load_entity_cache(), item)
+    hour = plugin.format_backfilled_hour(now - 4 * HOUR)
+    assert tenant.ingested_lines
+    for line in tenant.ingested_lines:
+        key = line.split(",", 1)[0]
+        assert key in ("consumption.DEM.RUM.backfilled", "consumption.DEM.Synthetic.backfilled", "consumption.DDU.backfilled")
+        assert f'backfilled_hour="{hour}"' in line
@@ -0,0 +1,88 @@
+"""
+Checks that calculate_host_units_batch returns what the per-host calculate_host_units returned before it was batched.
+
+Usage:
+python -m pytest tests
+"""
+import math
+import os
+import sys
+from math import ceil
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "bench"))
+from harness import load_plugin # noqa: E402
+
+license_plugin = load_plugin()
+LicensePluginRemote = license_plugin.LicensePluginRemote
+
+GIB = 1024 ** 3
+MONITORING_MODES = ("FULL_STACK", "INFRA_ONLY", "INFRASTRUCTURE", "DISCOVERY")
+
+def calculate_host_units(memory, monitoring_mode="FULL_STACK"):
+    """
+    Copy of LicensePluginRemote.calculate_host_units before host units were calculated in batches.
+    """
+    if memory <= 0:
+        return 0
+
+    if monitoring_mode == "INFRASTRUCTURE":
+        monitoring_mode = "INFRA_ONLY"
+
+    mem_gigs = memory / (1024 ** 3)
+
+    if mem_gigs >= 16:
+        if monitoring_mode == "FULL_STACK":
+            return ceil(mem_gigs / 16)
+        return min(ceil(mem_gigs / 16) * 0.3, 1.0)
+    else:
+        for mem, hu in LicensePluginRemote.min_host_units[monitoring_mode].items():
+            if mem_gigs < mem:
+                return hu
+
+def memories():
+    """
+    :return: Every breakpoint of the host unit tables and multiple of 16 GiB, a few bytes around them, zero and negative memories
+    """
+    breakpoints = {mem for table in LicensePluginRemote.min_host_units.values() for mem in table}
+    breakpoints.update(16 * multiple for multiple in range(1, 9))
+    values = {0, -1, -GIB, 1, 1.5}
+    for mem in breakpoints:
+        exact = mem * GIB
+        values.update(exact + delta for delta in (-3, -2, -1, -0.5, 0, 0.5, 1, 2, 3))
+    return sorted(values)
+
+def expected_host_units(memory, monitoring_mode):
+    try:
+        return calculate_host_units(memory, monitoring_mode)
+    except KeyError:
+        # Modes without a table raised below 16 GiB, the batch returns None for them instead
+        return None
+
+@pytest.fixture(scope="module")
+def plugin():
+    # Only the class attributes are needed, initialize() would open a session and state files
+    return LicensePluginRemote.__new__(LicensePluginRemote)
+
+@pytest.mark.parametrize("monitoring_mode", MONITORING_MODES)
+def test_batch_matches_per_host_calculation(plugin, monitoring_mode):
+    values = memories()
+    expected = [expected_host_units(memory, monitoring_mode) for memory in values]
+    assert plugin.calculate_host_units_batch(values, [monitoring_mode] * len(values)) == expected
+
+def test_batch_mixes_monitoring_modes(plugin):
+    values = memories()
+    modes = [MONITORING_MODES[index % len(MONITORING_MODES)] for index in range(len(values))]
+    expected = [expected_host_units(memory, mode) for memory, mode in zip(values, modes)]
+    assert plugin.calculate_host_units_batch(values, modes) == expected
+
+def test_discovery_below_16_gib(plugin):
+    assert plugin.calculate_host_units_batch([8 * GIB, 16 * GIB], ["DISCOVERY"] * 2) == [None, 0.3]
+
+def test_unknown_memory(plugin):
+    assert plugin.calculate_host_units_batch([math.nan], ["FULL_STACK"]) == [calculate_host_units(math.nan)] == [None]
+
+def test_infrastructure_alias(plugin):
+    values = memories()
+    assert plugin.calculate_host_units_batch(values, ["INFRASTRUCTURE"] * len(values)) == plugin.calculate_host_units_batch(values, ["INFRA_ONLY"] * len(values))
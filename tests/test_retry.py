@@ -0,0 +1,60 @@
+"""
+Tests the retries of API calls: the wait asked for by the tenant's headers and the retry loop of send().
+"""
+import email.utils
+import time
+import types
+
+import pytest
+
+@pytest.fixture
+def get_retry_wait(license_plugin):
+    # The plugin fixture does not wait for retries, the unpatched method is tested here
+    plugin = license_plugin.LicensePluginRemote.__new__(license_plugin.LicensePluginRemote)
+    return plugin.get_retry_wait
+
+def response(**headers):
+    return types.SimpleNamespace(headers={key.replace("_", "-"): value for key, value in headers.items()})
+
+def assert_waits(wait, seconds, license_plugin, tolerance=0):
+    assert seconds - tolerance <= wait <= seconds + license_plugin.RETRY_BACKOFF + tolerance
+
+def test_retry_after_seconds(get_retry_wait, license_plugin):
+    assert_waits(get_retry_wait(response(Retry_After="7"), 0), 7, license_plugin)
+    assert_waits(get_retry_wait(response(Retry_After="-3"), 0), 0, license_plugin)
+
+def test_retry_after_date(get_retry_wait, license_plugin):
+    retry_after = email.utils.formatdate(time.time() + 30, usegmt=True)
+    # The HTTP date only has whole seconds
+    assert_waits(get_retry_wait(response(Retry_After=retry_after), 0), 30, license_plugin, tolerance=1)
+
+@pytest.mark.parametrize("scale", [1_000_000, 1000, 1])
+def test_rate_limit_reset(get_retry_wait, license_plugin, scale):
+    reset = (time.time() + 20) * scale
+    assert_waits(get_retry_wait(response(X_RateLimit_Reset=str(reset)), 0), 20, license_plugin, tolerance=0.1)
+
+def test_rate_limit_reset_in_the_past(get_retry_wait, license_plugin):
+    assert_waits(get_retry_wait(response(X_RateLimit_Reset=str((time.time() - 20) * 1_000_000)), 0), 0, license_plugin)
+
+@pytest.mark.parametrize("headers", [{}, {"Retry_After": "soon"}, {"X_RateLimit_Reset": "later"}])
+def test_invalid_headers_fall_back_to_the_backoff(get_retry_wait, license_plugin, headers):
+    for attempt in range(8):
+        backoff = min(license_plugin.RETRY_BACKOFF_MAX, license_plugin.RETRY_BACKOFF * 2 ** attempt)
+        assert 0 <= get_retry_wait(response(**headers), attempt) <= backoff
+        assert 0 <= get_retry_wait(None, attempt) <= backoff
+
+def test_send_retries_throttled_calls(plugin, tenant):
+    tenant.throttle(2)
+    result = plugin.post_metric_lines("consumption.test 1\n", "test")
+    assert result["status"] == 202
+    assert tenant.stats["POST api/v2/metrics/ingest"] == 3
+    assert plugin.request_stats["requests"] == 3
+    assert plugin.request_stats["retries"] == plugin.request_stats["throttled"] == 2
+    assert tenant.ingested_lines == ["consumption.test 1"]
+
+def test_send_returns_the_last_throttled_response(plugin, tenant, license_plugin):
+    tenant.throttle(2)
+    result = plugin.send("POST", f"{plugin.tenant_id}/{license_plugin.METRIC_INGEST_ENDPOINT}?Api-Token={plugin.token}", data=b"consumption.test 1\n", retries=1)
+    assert result.status_code == 429
+    assert plugin.request_stats["retries"] == 1
+    assert tenant.ingested_lines == []
@@ -0,0 +1,147 @@
+"""
+Tests the scheduled hourly work: its order, what is carried over to the next execution and that a crash never pushes anything twice.
+"""
+import json
+
+import pytest
+
+HOUR = 60 * 60 * 1000
+
+def read_work(plugin):
+    with open(plugin.work_file, encoding="utf-8") as f:
+        return json.load(f)["work"]
+
+def record_work(plugin, results=None):
+    """
+    Replaces run_work_item, so the scheduler runs without pushing anything.
+
+    Parameters:
+    results(dict): Result or exception per work type, True for the others.
+
+    :return: List the run items are appended to
+    """
+    ran = []
+
+    def run_work_item(item, entity_definitions):
+        ran.append(item)
+        result = (results or {}).get(item["work"], True)
+        if isinstance(result, BaseException):
+            raise result
+        return result
+
+    plugin.run_work_item = run_work_item
+    return ran
+
+def test_work_runs_by_priority_then_hour(plugin):
+    now = plugin.current_millis
+    plugin.save_scheduled_work([
+        {"work": "Backfill", "from": now - 30 * HOUR, "to": now - 26 * HOUR, "done": []},
+        {"work": "HU", "from": now - HOUR, "to": now, "hosts": {}},
+        {"work": "DDU", "from": now - HOUR, "to": now},
+        {"work": "DEM", "from": now - HOUR, "to": now},
+        {"work": "DEM", "from": now - 2 * HOUR, "to": now - HOUR},
+    ])
+    ran = record_work(plugin)
+    plugin.run_scheduled_work()
+    assert [(item["work"], item["to"]) for item in ran] == [
+        ("DEM", now - HOUR), ("DEM", now), ("DDU", now), ("HU", now), ("Backfill", now - 26 * HOUR),
+    ]
+    assert read_work(plugin) == []
+
+def test_unfinished_work_is_carried_over(plugin, license_plugin):
+    now = plugin.current_millis
+    work = [
+        {"work": "DEM", "from": now - HOUR, "to": now},
+        {"work": "DDU", "from": now - HOUR, "to": now},
+        {"work": "Backfill", "from": now - 30 * HOUR, "to": now - 26 * HOUR, "done": []},
+    ]
+    plugin.save_scheduled_work(work)
+    ran = record_work(plugin, {"DDU": license_plugin.RequestBudgetExceeded("Out of API calls"), "Backfill": False})
+    plugin.run_scheduled_work()
+    assert [item["work"] for item in ran] == ["DEM", "DDU", "Backfill"]
+    assert read_work(plugin) == work[1:]
+
+def test_nothing_runs_without_budget(plugin):
+    now = plugin.current_millis
+    work = [{"work": "DEM", "from": now - HOUR, "to": now}, {"work": "HU", "from": now - HOUR, "to": now, "hosts": {}}]
+    plugin.save_scheduled_work(work)
+    plugin.request_budget = 0
+    ran = record_work(plugin)
+    plugin.run_scheduled_work()
+    assert ran == []
+    assert read_work(plugin) == work
+
+def test_waiting_and_expired_work(plugin, license_plugin):
+    now = plugin.current_millis
+    expired = now - license_plugin.WORK_MAX_AGE * HOUR - 1
+    prefetch = {"work": "Prefetch", "from": now, "to": now + 59 * 60 * 1000, "after": now + 30 * 60 * 1000}
+    plugin.save_scheduled_work([
+        prefetch,
+        {"work": "DDU", "from": expired - HOUR, "to": expired},
+        {"work": "Backfill", "from": expired - HOUR, "to": expired, "done": []},
+    ])
+    ran = record_work(plugin)
+    plugin.run_scheduled_work()
+    # Backfill items are never too old, they are bounded by BACKFILL_MAX_AGE when scheduled
+    assert [item["work"] for item in ran] == ["Backfill"]
+    assert read_work(plugin) == [prefetch]
+
+def test_skipped_prefetch_only_checks_management_zone_rules(plugin):
+    now = plugin.current_millis
+    plugin.save_scheduled_work([{"work": "Prefetch", "from": now - 2 * HOUR, "to": now - HOUR, "after": now - 90 * 60 * 1000}])
+    ran = record_work(plugin)
+    plugin.run_scheduled_work()
+    assert ran == [{"work": "MZ rules", "from": now - 2 * HOUR, "to": now - HOUR}]
+    assert read_work(plugin) == []
+
+def test_done_work_is_removed_before_a_crash(plugin):
+    now = plugin.current_millis
+    plugin.save_scheduled_work([
+        {"work": "DEM", "from": now - HOUR, "to": now},
+        {"work": "DDU", "from": now - HOUR, "to": now},
+        {"work": "HU", "from": now - HOUR, "to": now, "hosts": {}},
+    ])
+    record_work(plugin, {"DDU": KeyboardInterrupt()})
+    with pytest.raises(KeyboardInterrupt):
+        plugin.run_scheduled_work()
+    assert [item["work"] for item in read_work(plugin)] == ["DDU", "HU"]
+
+def test_late_work_is_pushed_as_backfilled(harness, tenant):
+    plugin = harness.plugin
+    harness.run_minute()
+    plugin.get_ddu = plugin.get_hu = False
+    now = plugin.current_millis
+    plugin.save_scheduled_work([{"work": "DEM", "from": now - 3 * HOUR, "to": now - 2 * HOUR}])
+    harness.run_minute()
+    assert tenant.ingested_lines
+    assert all(line.startswith("consumption.DEM.") and ".backfilled," in line and "backfilled_hour=" in line for line in tenant.ingested_lines)
+
+def test_crash_mid_backfill_pushes_nothing_twice(harness, tenant):
+    plugin = harness.plugin
+    harness.run_minute()
+    now = plugin.current_millis
+    plugin.schedule_backfill(now - 5 * HOUR, now - 3 * HOUR)
+    push_ddu = plugin.calculate_and_push_consumption_for_ddu
+
+    def crash_on_backfill(*args, backfilled_hour=None, **kwargs):
+        if backfilled_hour is not None:
+            raise KeyboardInterrupt()
+        return push_ddu(*args, backfilled_hour=backfilled_hour, **kwargs)
+
+    plugin.calculate_and_push_consumption_for_ddu = crash_on_backfill
+    with pytest.raises(KeyboardInterrupt):
+        harness.run_hour()
+    [backfill, prefetch] = read_work(plugin)
+    assert backfill["work"] == "Backfill" and backfill["from"] == now - 5 * HOUR and backfill["done"] == ["DEM"]
+    assert prefetch["work"] == "Prefetch"
+
+    # Restarted, the plugin only knows what was written to disk
+    del plugin.calculate_and_push_consumption_for_ddu
+    plugin.scheduled_work = None
+    harness.run_minute()
+    assert [item["work"] for item in read_work(plugin)] == ["Prefetch"]
+    lines = [line for line in tenant.ingested_lines if not line.startswith("consumption.plugin.")]
+    assert len(lines) == len(set(lines))
+    for key in ("consumption.DEM.RUM.backfilled,", "consumption.DDU.backfilled,"):
+        hours = {line.split('backfilled_hour="')[1].split('"')[0] for line in lines if line.startswith(key)}
+        assert hours == {plugin.format_backfilled_hour(now - 4 * HOUR), plugin.format_backfilled_hour(now - 3 * HOUR)}
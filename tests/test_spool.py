@@ -0,0 +1,98 @@
+"""
+Tests the ingest spool: failed batches are kept on disk and replayed with backoff by later executions.
+"""
+import os
+import time
+
+import requests
+
+def spooled_files(plugin):
+    return sorted(name for name in os.listdir(plugin.spool_directory) if name.endswith(".lp"))
+
+def age(path, seconds):
+    """
+    Moves the modification time of ``path``, the time the batch was last tried, ``seconds`` into the past.
+    """
+    then = time.time() - seconds
+    os.utime(path, (then, then))
+
+def fail_ingest(plugin):
+    session_request = plugin.session.request
+
+    def request(method, url, **kwargs):
+        if method == "POST":
+            raise requests.exceptions.ConnectionError("Ingest unreachable")
+        return session_request(method, url, **kwargs)
+
+    plugin.session.request = request
+
+def test_accepted_batch_leaves_no_spool_file(plugin, tenant):
+    result = plugin.push_metric_lines("consumption.test 1\n", "DEM RUM")
+    assert result["status"] == 202
+    assert spooled_files(plugin) == []
+    assert tenant.ingested_lines == ["consumption.test 1"]
+
+def test_failed_batch_is_spooled_and_done(plugin):
+    fail_ingest(plugin)
+    result = plugin.push_metric_lines("consumption.test 1\n", "DEM RUM")
+    # Reported as failed, but kept in the spool instead of raising, so the work that built it is not redone
+    assert result["status"] == 0 and "Ingest unreachable" in result["error"]
+    [name] = spooled_files(plugin)
+    created, batch_id, attempts, description = name[:-len(".lp")].split("-", 3)
+    assert abs(int(created) - time.time() * 1000) < 60 * 1000
+    assert len(batch_id) == 32
+    assert attempts == "0"
+    assert description == "DEM_RUM"
+    with open(os.path.join(plugin.spool_directory, name), encoding="utf-8") as f:
+        assert f.read() == "consumption.test 1\n"
+
+def test_replay_waits_for_the_backoff(plugin, tenant, license_plugin):
+    path = plugin.spool_batch("consumption.test 1\n", "HU")
+    plugin.replay_spooled_batches()
+    assert os.path.isfile(path)
+    assert tenant.ingested_lines == []
+    age(path, license_plugin.SPOOL_RETRY_BACKOFF)
+    plugin.replay_spooled_batches()
+    assert not os.path.isfile(path)
+    assert tenant.ingested_lines == ["consumption.test 1"]
+
+def test_failed_replay_counts_the_retry(plugin, tenant, license_plugin):
+    path = plugin.spool_batch("consumption.test 1\n", "HU")
+    age(path, license_plugin.SPOOL_RETRY_BACKOFF)
+    fail_ingest(plugin)
+    plugin.replay_spooled_batches()
+    [name] = spooled_files(plugin)
+    assert name == os.path.basename(path).replace("-0-HU.lp", "-1-HU.lp")
+    assert time.time() - os.path.getmtime(os.path.join(plugin.spool_directory, name)) < 60
+
+def test_replay_posts_once_without_retries(plugin, tenant, license_plugin):
+    path = plugin.spool_batch("consumption.test 1\n", "HU")
+    age(path, license_plugin.SPOOL_RETRY_BACKOFF)
+    tenant.throttle(1)
+    plugin.replay_spooled_batches()
+    assert tenant.stats["POST api/v2/metrics/ingest"] == 1
+    assert spooled_files(plugin) == [os.path.basename(path).replace("-0-HU.lp", "-1-HU.lp")]
+
+def test_expired_batches_are_dropped(plugin, tenant, license_plugin):
+    created = int(time.time() * 1000) - license_plugin.SPOOL_MAX_AGE * 60 * 60 * 1000 - 1
+    path = os.path.join(plugin.spool_directory, f"{created}-{'0' * 32}-3-HU.lp")
+    with open(path, mode="w", encoding="utf-8") as f:
+        f.write("consumption.test 1\n")
+    age(path, license_plugin.SPOOL_RETRY_BACKOFF_MAX)
+    plugin.replay_spooled_batches()
+    assert not os.path.isfile(path)
+    assert tenant.stats.get("POST api/v2/metrics/ingest", 0) == 0
+
+def test_foreign_files_are_skipped(plugin, tenant, license_plugin):
+    foreign = os.path.join(plugin.spool_directory, "x.lp")
+    with open(foreign, mode="w", encoding="utf-8") as f:
+        f.write("not a batch")
+    leftover = os.path.join(plugin.spool_directory, "1-2-0-HU.lp.tmp")
+    with open(leftover, mode="w", encoding="utf-8") as f:
+        f.write("consumption.test")
+    path = plugin.spool_batch("consumption.test 1\n", "HU")
+    age(path, license_plugin.SPOOL_RETRY_BACKOFF)
+    plugin.replay_spooled_batches()
+    assert os.path.isfile(foreign)
+    assert not os.path.isfile(leftover)
+    assert tenant.ingested_lines == ["consumption.test 1"]
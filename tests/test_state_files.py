@@ -0,0 +1,45 @@
+"""
+Tests the state files: writes never leave a truncated file behind, and reads fall back to the previous generation.
+"""
+import json
+import os
+
+def write(path, data):
+    with open(path, mode="w", encoding="utf-8") as f:
+        f.write(data)
+
+def test_write_keeps_the_previous_generation(plugin):
+    path = plugin.tempfile
+    plugin.write_state_file(path, json.dumps({"last_millis": 1, "hosts": {}}))
+    plugin.write_state_file(path, json.dumps({"last_millis": 2, "hosts": {}}))
+    assert not os.path.isfile(path + ".tmp")
+    with open(path + ".prev", encoding="utf-8") as f:
+        assert json.load(f)["last_millis"] == 1
+    assert plugin.read_state_file(path, ("last_millis", "hosts"))["last_millis"] == 2
+
+def test_read_falls_back_to_the_previous_generation(plugin):
+    path = plugin.tempfile
+    plugin.write_state_file(path, json.dumps({"last_millis": 1, "hosts": {}}))
+    plugin.write_state_file(path, json.dumps({"last_millis": 2, "hosts": {}}))
+    write(path, '{"last_millis": 3, "ho')
+    assert plugin.read_state_file(path, ("last_millis", "hosts"))["last_millis"] == 1
+
+def test_read_falls_back_when_a_key_is_missing(plugin):
+    path = plugin.tempfile
+    plugin.write_state_file(path, json.dumps({"last_millis": 1, "hosts": {}}))
+    plugin.write_state_file(path, json.dumps({"last_millis": 2}))
+    assert plugin.read_state_file(path, ("last_millis", "hosts"))["last_millis"] == 1
+
+def test_read_skips_an_empty_file(plugin):
+    path = plugin.tempfile
+    plugin.write_state_file(path, json.dumps({"last_millis": 1, "hosts": {}}))
+    plugin.write_state_file(path, json.dumps({"last_millis": 2, "hosts": {}}))
+    write(path, "")
+    assert plugin.read_state_file(path, ("last_millis", "hosts"))["last_millis"] == 1
+
+def test_read_without_any_valid_generation(plugin):
+    path = plugin.tempfile
+    assert plugin.read_state_file(path, ("last_millis", "hosts")) is None
+    write(path, "not json")
+    write(path + ".prev", "[]")
+    assert plugin.read_state_file(path, ("last_millis", "hosts")) is None